@@ -0,0 +1,78 @@
+#!/usr/bin/env python2
+'''Compare the category index with the old per-call categories.json helpers.
+
+Usage (from the root of this repo):
+
+    python benchmarks/bench_categories.py
+
+'''
+import json
+import os.path
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import ckanext.sgdata.lookups as lookups
+
+
+def legacy_categories():
+    '''The categories() helper before the category index was added.
+
+    It parsed the categories file on every call.
+
+    '''
+    categories = json.loads(open(lookups.CATEGORIES_FILE, 'r').read())
+    return categories['categories'].values()
+
+
+def legacy_first_level_category(value):
+    for c in legacy_categories():
+        if c['value'] == value:
+            parent = c['parent']
+    for c in legacy_categories():
+        if c['value'] == parent:
+            return c['label']
+
+
+def legacy_second_level_category(value):
+    for c in legacy_categories():
+        if c['value'] == value:
+            return c['label']
+
+
+def first_level_category(value):
+    return lookups.categories.get().by_value[value].parent_label
+
+
+def second_level_category(value):
+    return lookups.categories.get().by_value[value].label
+
+
+def main():
+    values = sorted(lookups.categories.get().by_value)
+    last = values[-1]
+    number = 2000
+
+    cases = (
+        ('categories()', legacy_categories,
+         lambda: lookups.categories.get().tree),
+        ('first_level_category()',
+         lambda: legacy_first_level_category(last),
+         lambda: first_level_category(last)),
+        ('second_level_category()',
+         lambda: legacy_second_level_category(last),
+         lambda: second_level_category(last)),
+        )
+
+    print('{0:<26}{1:>14}{2:>14}{3:>10}'.format(
+        'helper', 'old (us/call)', 'new (us/call)', 'speedup'))
+    for name, old, new in cases:
+        old_time = min(timeit.repeat(old, number=number, repeat=3)) / number
+        new_time = min(timeit.repeat(new, number=number, repeat=3)) / number
+        print('{0:<26}{1:>14.2f}{2:>14.2f}{3:>9.0f}x'.format(
+            name, old_time * 1e6, new_time * 1e6, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
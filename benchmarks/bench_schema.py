@@ -0,0 +1,66 @@
+#!/usr/bin/env python2
+'''Compare building the package schemas each time with the cached schemas.
+
+This needs to be run in CKAN's virtualenv, with a CKAN config file that has
+the sgdatasetform plugin enabled:
+
+    python benchmarks/bench_schema.py /etc/ckan/default/development.ini [dataset]
+
+If a dataset name or id is given, the time that package_show takes for that
+dataset is measured too.
+
+'''
+import os.path
+import sys
+import timeit
+
+
+def load_environment(config_path):
+    import paste.deploy
+    import ckan.config.environment
+
+    conf = paste.deploy.appconfig('config:' + os.path.abspath(config_path))
+    ckan.config.environment.load_environment(conf.global_conf,
+                                             conf.local_conf)
+
+
+def main():
+    load_environment(sys.argv[1])
+    dataset = sys.argv[2] if len(sys.argv) > 2 else None
+
+    import ckan.plugins as plugins
+    import ckan.plugins.toolkit as toolkit
+    import ckanext.sgdata.plugin as plugin
+
+    form = plugins.get_plugin('sgdatasetform')
+
+    def uncached(func):
+        '''Call func as if the schemas weren't cached, like they used to be.'''
+        def wrapper():
+            plugin._schema_templates.clear()
+            return func()
+        return wrapper
+
+    def package_show():
+        toolkit.get_action('package_show')({'ignore_auth': True},
+                                           {'id': dataset})
+
+    cases = [('create_package_schema()', form.create_package_schema),
+             ('update_package_schema()', form.update_package_schema),
+             ('show_package_schema()', form.show_package_schema)]
+    if dataset:
+        cases.append(('package_show', package_show))
+
+    number = 200
+    print('{0:<26}{1:>14}{2:>14}{3:>10}'.format(
+        'call', 'old (us/call)', 'new (us/call)', 'speedup'))
+    for name, func in cases:
+        old_time = min(timeit.repeat(uncached(func), number=number,
+                                     repeat=3)) / number
+        new_time = min(timeit.repeat(func, number=number, repeat=3)) / number
+        print('{0:<26}{1:>14.2f}{2:>14.2f}{3:>9.1f}x'.format(
+            name, old_time * 1e6, new_time * 1e6, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+#!/usr/bin/env python2
+'''Compare the old importer keyword_translate() with keywords.normalise_tags().
+
+Usage (from the root of this repo):
+
+    python benchmarks/bench_tags.py [number of keywords]
+
+The keywords are a synthetic list (100,000 by default) of mixed-case words
+with punctuation and duplicates, as byte strings like the importer reads from
+the CSV file and as unicode strings like the web form submits.
+
+'''
+import os.path
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import stubs
+stubs.install()
+
+import ckanext.sgdata.keywords as keywords
+
+
+def legacy_normalise_tags(names):
+    '''The importer's keyword handling before the keywords module.'''
+    def keyword_translate(keyword):
+        '''Transform string into a valid CKAN tag name.'''
+        translated_keyword = ''
+        for char in keyword:
+            if char.isalnum() or char in '-._ ':
+                translated_keyword = translated_keyword + char
+        return translated_keyword
+    return list(set(keyword_translate(name.strip()) for name in names
+                    if name.strip()))
+
+
+def make_keywords(number):
+    rng = random.Random(0)
+    words = ['Population', 'GDP', 'trade&industry', ' labour force ',
+             'Consumer Price Index (CPI)', 'e-commerce', 'R&D', 'Housing/HDB']
+    return ['{0} {1}'.format(rng.choice(words), rng.randint(0, number // 4))
+            for i in range(number)]
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    byte_names = make_keywords(number)
+    unicode_names = [name.decode('utf-8') for name in byte_names]
+
+    cases = (
+        ('bytes', lambda: legacy_normalise_tags(byte_names),
+         lambda: keywords.normalise_tags(byte_names)),
+        ('unicode', lambda: legacy_normalise_tags(unicode_names),
+         lambda: keywords.normalise_tags(unicode_names)),
+        )
+
+    print('{0} keywords'.format(number))
+    print('{0:<12}{1:>14}{2:>14}{3:>10}'.format(
+        'keywords', 'old (ms)', 'new (ms)', 'speedup'))
+    for name, old, new in cases:
+        old_time = min(timeit.repeat(old, number=1, repeat=3))
+        new_time = min(timeit.repeat(new, number=1, repeat=3))
+        print('{0:<12}{1:>14.1f}{2:>14.1f}{3:>9.1f}x'.format(
+            name, old_time * 1e3, new_time * 1e3, old_time / new_time))
+
+
+if __name__ == '__main__':
+    main()
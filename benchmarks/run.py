@@ -0,0 +1,304 @@
+#!/usr/bin/env python2
+'''Run the offline benchmark suite and write the results as JSON.
+
+Usage (from the root of this repo):
+
+    python benchmarks/run.py [--output results.json] [--compare old.json]
+                             [--rows 100000] [--threshold 1.2]
+
+CKAN isn't needed: the plugin and the import commands are run against the
+stand-ins in benchmarks/stubs.py. Each case is timed with timeit and its best
+time per call, in microseconds, is written out. The CSV cases run the
+importer's compiled row transform, and the whole read_datasets_from_csv_file()
+pipeline, on a synthetic file of --rows rows that's generated in a temporary
+directory.
+
+With --compare, the results are compared with an earlier results file, and
+the script exits with status 1 if any case got more than --threshold times
+slower, so it can be run before a deploy to catch regressions.
+
+'''
+import argparse
+import contextlib
+import csv
+import itertools
+import json
+import os
+import os.path
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import stubs
+stubs.install()
+
+import ckanext.sgdata.commands as commands
+import ckanext.sgdata.lookups as lookups
+import ckanext.sgdata.plugin as plugin
+import ckanext.sgdata.vocabularies as vocabularies
+
+
+@contextlib.contextmanager
+def quiet():
+    '''Hide anything the code being timed prints.'''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def valid_dataset():
+    '''Return a dataset dict that passes _custom_validation().'''
+    dataset = dict((field, 'x') for field in
+                   plugin.SIMPLE_MANDATORY_TEXT_FIELDS)
+    dataset.update({
+        'name': 'bench-dataset',
+        'title': 'Benchmark dataset',
+        'tags': [{'name': 'population'}, {'name': 'trade'}],
+        'category': sorted(lookups.categories.get().by_value)[-1],
+        'department': sorted(lookups.departments.get().by_value)[0],
+        'reference-period-start': '01/01/2014',
+        'reference-period-end': '12/31/2014',
+        'available-from': '01/01/2015',
+        })
+    for (name, tags) in vocabularies.VOCABULARIES:
+        dataset[name] = tags[0]
+    return dataset
+
+
+def invalid_dataset():
+    '''Return a dataset dict that fails most of _custom_validation().'''
+    return {'title': '', 'category': '99.99', 'department': 'NOPE',
+            'status': 'Unknown', 'reference-period-start': '12/31/2014',
+            'reference-period-end': '01/01/2014'}
+
+
+def csv_header(field):
+    '''Return the CSV column header that the importer reads as field.'''
+    for (header, translation) in commands.HEADER_TRANSLATIONS.items():
+        if translation == field:
+            return header
+    return field.replace('_', ' ').upper()
+
+
+def write_csv_file(path, rows):
+    '''Write a synthetic CSV file in the layout that the importer reads.
+
+    The rows are written directly, with the CSV file's codes, YYYYMMDD dates
+    and category level numbers, rather than by the exporter.
+
+    '''
+    rng = random.Random(0)
+    categories = sorted(code for (code, category)
+                        in lookups.categories.get().by_code.items()
+                        if category.level == 2)
+    departments = sorted(lookups.departments.get().by_value)
+    codes = dict((field, sorted(values)) for (field, values) in
+                 commands.CODE_TRANSLATIONS.items())
+    keywords = ['Population', 'trade', 'GDP', 'housing', 'transport',
+                'health', 'education', 'labour force']
+    text_fields = [field for field in plugin.SIMPLE_MANDATORY_TEXT_FIELDS
+                   if field != 'category']
+    fields = (['sg_data_record_identifier', 'title', 'notes',
+               'first_level_category', 'second_level_category',
+               'third_level_category', 'keywords', 'department', 'comments',
+               'data_provider_url'] + text_fields + sorted(codes) +
+              list(commands.DATE_FIELDS))
+
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow([csv_header(field) for field in fields])
+        for i in range(rows):
+            row = dict((field, '{0} {1}'.format(field, i))
+                       for field in text_fields)
+            (first_level, second_level) = rng.choice(categories).split('.')
+            row.update({
+                'sg_data_record_identifier': 'REC-{0:06}'.format(i),
+                'title': 'Synthetic dataset {0}'.format(i),
+                'notes': 'Description of synthetic dataset {0}'.format(i),
+                'first_level_category': first_level,
+                'second_level_category': second_level,
+                'third_level_category': '',
+                'keywords': ', '.join(rng.sample(keywords, 3)),
+                'department': rng.choice(departments),
+                'comments': '',
+                'data_provider_url': 'http://example.com/{0}'.format(i),
+                'reference-period-start': '20140101',
+                'reference-period-end': '20141231',
+                'available-from': '20150101',
+                })
+            for (field, values) in codes.items():
+                row[field] = rng.choice(values)
+            writer.writerow([row[field] for field in fields])
+
+
+def read_csv_file(path):
+    with quiet():
+        for (i, dataset) in commands.read_datasets_from_csv_file(path,
+                                                                 'org'):
+            pass
+
+
+def transform_rows(path, number):
+    '''Return a function that transforms number rows of the CSV file.
+
+    The rows are read and the transform is compiled beforehand, so only the
+    compiled transform itself (and copying each row) is timed.
+
+    '''
+    transform = commands.compile_transform(
+        commands.read_fields_from_csv_file(path), 'org')
+    rows = list(itertools.islice(commands.read_rows_from_csv_file(path),
+                                 number))
+
+    def run():
+        for (line_number, row) in rows:
+            transform(dict(row), line_number)
+    return run
+
+
+def uncached(func):
+    '''Call func as if the schemas weren't cached.'''
+    def wrapper():
+        plugin._schema_templates.clear()
+        return func()
+    return wrapper
+
+
+def cases(csv_path):
+    '''Return (name, function, number of calls per timing) for each case.'''
+    form = plugin.SGDatasetForm()
+    category = sorted(lookups.categories.get().by_value)[-1]
+    department = sorted(lookups.departments.get().by_value)[-1]
+    valid = valid_dataset()
+    invalid = invalid_dataset()
+
+    return [
+        ('categories()', plugin.categories, 10000),
+        ('first_level_category()',
+         lambda: plugin.first_level_category(category), 10000),
+        ('second_level_category()',
+         lambda: plugin.second_level_category(category), 10000),
+        ('departments()', plugin.departments, 10000),
+        ('department()', lambda: plugin.department(department), 10000),
+        ('types_of_data_collection()', plugin.types_of_data_collection,
+         10000),
+        ('statuses()', plugin.statuses, 10000),
+        ('frequencies()', plugin.frequencies, 10000),
+        ('security_classifications()', plugin.security_classifications,
+         10000),
+        ('data_granularities()', plugin.data_granularities, 10000),
+        ('publish_on_data_gov_sg()', plugin.publish_on_data_gov_sg, 10000),
+        ('create_package_schema()', form.create_package_schema, 1000),
+        ('update_package_schema()', form.update_package_schema, 1000),
+        ('show_package_schema()', form.show_package_schema, 1000),
+        ('create_package_schema() uncached',
+         uncached(form.create_package_schema), 200),
+        ('_custom_validation() valid',
+         lambda: plugin._custom_validation(valid), 2000),
+        ('_custom_validation() invalid',
+         lambda: plugin._custom_validation(invalid), 2000),
+        ('sgdata_category_autocomplete',
+         lambda: plugin.sgdata_category_autocomplete({}, {'q': u'popul'}),
+         2000),
+        ('sgdata_keyword_autocomplete',
+         lambda: plugin.sgdata_keyword_autocomplete({}, {'q': u'topic 1'}),
+         2000),
+        ('compiled transform, 1000 rows', transform_rows(csv_path, 1000),
+         20),
+        ('read_datasets_from_csv_file()', lambda: read_csv_file(csv_path),
+         1),
+        ]
+
+
+def run(rows):
+    directory = tempfile.mkdtemp(prefix='sgdata-bench-')
+    try:
+        csv_path = os.path.join(directory, 'datasets.csv')
+        write_csv_file(csv_path, rows)
+
+        results = {}
+        for (name, func, number) in cases(csv_path):
+            # Warm up the caches, as they would be on a running site. The
+            # slow cases that are only called once are timed fewer times.
+            if number > 1:
+                func()
+                repeat = 5
+            else:
+                repeat = 3
+            best = min(timeit.repeat(func, number=number,
+                                     repeat=repeat)) / number
+            results[name] = {'number': number, 'us_per_call': best * 1e6}
+            sys.stderr.write('{0:<36}{1:>16.2f} us/call\n'.format(
+                name, best * 1e6))
+    finally:
+        shutil.rmtree(directory)
+
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'csv_rows': rows,
+        'results': results,
+        }
+
+
+def compare(old, new, threshold):
+    '''Print how each case changed and return the names of the regressions.'''
+    regressions = []
+    sys.stderr.write('\n{0:<36}{1:>12}{2:>12}{3:>10}\n'.format(
+        'case', 'old (us)', 'new (us)', 'ratio'))
+    for (name, result) in sorted(new['results'].items()):
+        if name not in old['results']:
+            continue
+        old_time = old['results'][name]['us_per_call']
+        ratio = result['us_per_call'] / old_time
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  SLOWER'
+        sys.stderr.write('{0:<36}{1:>12.2f}{2:>12.2f}{3:>9.2f}x{4}\n'.format(
+            name, old_time, result['us_per_call'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', help='File to write the results to '
+                        '(default: standard output)')
+    parser.add_argument('--compare', help='Earlier results file to compare '
+                        'the results with')
+    parser.add_argument('--rows', type=int, default=100000,
+                        help='Number of rows in the synthetic CSV file')
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help='How many times slower a case can get before '
+                        'it counts as a regression')
+    args = parser.parse_args()
+
+    results = run(args.rows)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            old = json.load(f)
+        if compare(old, results, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
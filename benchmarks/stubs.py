@@ -0,0 +1,193 @@
+'''Stand-ins for CKAN and ckanapi so the plugin can be benchmarked offline.
+
+Call :py:func:`install` before importing anything from ``ckanext.sgdata``.
+It puts minimal fake ``ckan``, ``pylons``, ``paste`` and ``ckanapi`` modules
+into ``sys.modules``, with just enough in them for the plugin and the import
+commands to be imported and for their pure-Python code paths to run. The
+fake ``vocabulary_list`` action serves the tags from
+:py:data:`ckanext.sgdata.vocabularies.VOCABULARIES`.
+
+The stubs are always used, even if CKAN is installed, so that results from
+different machines measure the same code.
+
+'''
+import sys
+import types
+
+
+class ValidationError(Exception):
+    def __init__(self, error_dict):
+        Exception.__init__(self, error_dict)
+        self.error_dict = error_dict
+
+
+class ObjectNotFound(Exception):
+    pass
+
+
+class NotAuthorized(Exception):
+    pass
+
+
+class Invalid(Exception):
+    pass
+
+
+class CKANAPIError(Exception):
+    pass
+
+
+# The fake action functions, by name.
+ACTIONS = {}
+
+
+def get_action(name):
+    return ACTIONS[name]
+
+
+def get_validator(name):
+    def validator(value=None, *args):
+        return value
+    validator.__name__ = name
+    return validator
+
+
+def get_converter(name):
+    if name in ('convert_to_tags', 'convert_from_tags'):
+        return lambda vocab: get_validator('{0}({1})'.format(name, vocab))
+    return get_validator(name)
+
+
+def side_effect_free(action):
+    action.side_effect_free = True
+    return action
+
+
+def _vocabulary_list(context, data_dict):
+    import ckanext.sgdata.vocabularies as vocabularies
+    return [{'id': name, 'name': name,
+             'tags': [{'name': tag} for tag in tags]}
+            for (name, tags) in vocabularies.VOCABULARIES]
+
+
+def _tag_list(context, data_dict):
+    return [u'keyword {0} topic {1}'.format(i, i % 101) for i in range(20000)]
+
+
+ACTIONS['vocabulary_list'] = _vocabulary_list
+ACTIONS['tag_list'] = _tag_list
+
+
+class DefaultDatasetForm(object):
+
+    '''The parts of CKAN's default schemas that the plugin modifies.'''
+
+    def _default_schema(self):
+        return {
+            'id': [get_validator('empty')],
+            'name': [get_validator('not_empty'), unicode],
+            'title': [get_validator('if_empty_same_as'), unicode],
+            'notes': [get_validator('ignore_missing'), unicode],
+            'owner_org': [get_validator('owner_org_validator'), unicode],
+            'tags': {'name': [get_validator('not_missing'),
+                              get_validator('tag_name_validator')],
+                     '__extras': [get_validator('ignore')]},
+            'resources': {'url': [get_validator('not_empty'), unicode],
+                          'name': [get_validator('ignore_missing'), unicode]},
+            'extras': {'key': [get_validator('not_empty'), unicode],
+                       'value': [get_validator('not_missing')]},
+            '__extras': [get_validator('ignore')],
+            }
+
+    def create_package_schema(self):
+        return self._default_schema()
+
+    def update_package_schema(self):
+        return self._default_schema()
+
+    def show_package_schema(self):
+        return self._default_schema()
+
+
+class SingletonPlugin(object):
+    pass
+
+
+class Interface(object):
+    pass
+
+
+def implements(interface, inherit=False):
+    pass
+
+
+def _module(name, **attrs):
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    (parent, _, child) = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+def install():
+    '''Put the stub modules into sys.modules.'''
+    _module('ckan')
+    _module('ckan.plugins', SingletonPlugin=SingletonPlugin,
+            implements=implements)
+    for interface in ('IConfigurer', 'IConfigurable', 'IDatasetForm',
+                      'IRoutes', 'IActions', 'ITemplateHelpers', 'IFacets',
+                      'IPackageController', 'IMiddleware', 'IAuthFunctions'):
+        setattr(sys.modules['ckan.plugins'], interface, Interface)
+    _module('ckan.plugins.toolkit',
+            ValidationError=ValidationError, ObjectNotFound=ObjectNotFound,
+            NotAuthorized=NotAuthorized, Invalid=Invalid,
+            get_action=get_action, get_validator=get_validator,
+            get_converter=get_converter, side_effect_free=side_effect_free,
+            check_access=lambda *args, **kwargs: True,
+            DefaultDatasetForm=DefaultDatasetForm, BaseController=object,
+            _=lambda string: string,
+            asbool=lambda value: str(value).lower() in ('true', 'yes', '1'),
+            add_template_directory=lambda *args: None,
+            add_public_directory=lambda *args: None,
+            add_resource=lambda *args: None)
+    _module('ckan.lib')
+    _module('ckan.lib.helpers', url_for=lambda *args, **kwargs: '/',
+            lang=lambda: 'en')
+    _module('ckan.lib.cli', CkanCommand=object)
+    _module('ckan.model')
+    _module('ckan.logic')
+    _module('ckan.logic.action')
+    for name in ('create', 'update', 'delete', 'get', 'patch'):
+        _module('ckan.logic.action.' + name)
+    _module('ckan.controllers')
+    _module('ckan.controllers.package', PackageController=object)
+    _module('pylons', session={}, config={})
+
+    _module('ckanapi', RemoteCKAN=lambda *args, **kwargs: None)
+    _module('ckanapi.errors', CKANAPIError=CKANAPIError)
+
+    _module('paste')
+    _module('paste.script')
+    _module('paste.script.command', Command=_Command)
+
+    try:
+        import requests
+        import requests.adapters
+    except ImportError:
+        _module('requests', Session=object, get=None)
+        _module('requests.exceptions', ConnectionError=IOError,
+                Timeout=IOError)
+        _module('requests.adapters', HTTPAdapter=lambda **kwargs: None)
+
+
+class _Parser(object):
+    def add_option(self, *args, **kwargs):
+        pass
+
+
+class _Command(object):
+    @staticmethod
+    def standard_parser(**kwargs):
+        return _Parser()
@@ -1,30 +1,62 @@
 #!/usr/bin/env python2
-'''Produce a categories.json filed from a categories.csv file.'''
+'''Produce a categories.json file from a categories.csv file.
 
+Each row of categories.csv has a first-level category code and label and a
+second-level code and label, optionally followed by a third-level code (like
+"1.02.03") and label:
+
+    1,Population,1.02,Basic Demographic Characteristics[,1.02.03,Age]
+
+categories.json is a flat index of every code, at any level, with its label,
+level, parent code and the path of codes down to it. It's written with the
+format version that the plugin expects and a checksum of the index, so that
+a stale or hand-edited file is refused when the plugin loads it.
+
+'''
 import csv
+import hashlib
 import json
 
+from ckanext.sgdata.lookups import (CATEGORIES_FORMAT_VERSION,
+                                    categories_checksum)
+
+
+def add(categories, value, label, parent):
+    '''Add a category to the flat index, checking it's consistent.'''
+    path = (categories[parent]['path'] if parent else []) + [value]
+    category = {'value': value, 'label': label, 'level': len(path),
+                'parent': parent, 'path': path}
+    assert categories.get(value, category) == category, value
+    categories[value] = category
+
+
 categories = {}
-f = open('categories.csv', 'rt')
+f = open('categories.csv', 'rb')
 try:
-    reader = csv.reader(f)
-    for row in reader:
-        (top_level_value, top_level_label, second_level_value,
-            second_level_label) = row
-
-        assert len(second_level_value.split('.')[1]) == 2, second_level_value
-
-        if top_level_value not in categories:
-            categories[top_level_value] = {'value': top_level_value,
-                                           'label': top_level_label,
-                                           'categories': {}}
-
-        if second_level_value not in categories[top_level_value]['categories']:
-            categories[top_level_value]['categories'][second_level_value] = {
-                'value':  second_level_value,
-                'label': second_level_label,
-                'parent_label': top_level_label}
+    source = f.read()
 finally:
     f.close()
 
-open('categories.json', 'w').write(json.dumps(categories))
+for row in csv.reader(source.splitlines()):
+    (top_level_value, top_level_label, second_level_value,
+        second_level_label) = row[:4]
+
+    assert second_level_value.split('.')[0] == top_level_value, row
+    assert len(second_level_value.split('.')[1]) == 2, second_level_value
+
+    add(categories, top_level_value, top_level_label, None)
+    add(categories, second_level_value, second_level_label, top_level_value)
+
+    if len(row) > 4 and row[4]:
+        (third_level_value, third_level_label) = row[4:6]
+        assert third_level_value.rsplit('.', 1)[0] == second_level_value, row
+        assert len(third_level_value.split('.')[2]) == 2, third_level_value
+        add(categories, third_level_value, third_level_label,
+            second_level_value)
+
+open('categories.json', 'w').write(json.dumps({
+    'format_version': CATEGORIES_FORMAT_VERSION,
+    'source_checksum': hashlib.sha256(source).hexdigest(),
+    'checksum': categories_checksum(categories),
+    'categories': categories,
+    }, sort_keys=True))
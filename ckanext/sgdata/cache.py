@@ -0,0 +1,110 @@
+'''Small in-process caches shared by the plugin's helpers and actions.'''
+import collections
+import hashlib
+import threading
+
+
+class LRUCache(object):
+
+    '''A thread-safe, size-bounded, least-recently-used cache.
+
+    When more than ``maxsize`` items are cached the least recently used one
+    is dropped. ``hits`` and ``misses`` count the lookups made with
+    :py:meth:`get`.
+
+    '''
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+    def stats(self):
+        return {'size': len(self._items), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses}
+
+
+class FragmentCache(object):
+
+    '''A cache of rendered HTML fragments, stored in a pluggable backend.
+
+    The backend can be any object with ``get(key, default)`` and
+    ``set(key, value)`` methods taking string keys, such as an
+    :py:class:`LRUCache` or a memcached client. ``hits`` and ``misses`` are
+    counted here rather than by the backend, so they're available whichever
+    backend is used.
+
+    '''
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *parts):
+        '''Return the backend key for a fragment identified by parts.'''
+        return 'sgdata-fragment:' + hashlib.sha1(
+            u'|'.join(parts).encode('utf-8')).hexdigest()
+
+    def get_or_render(self, parts, render):
+        '''Return the fragment identified by parts, rendering it if needed.
+
+        ``render`` is called with no arguments to render the fragment when
+        it isn't in the cache.
+
+        '''
+        key = self.key(*parts)
+        fragment = self.backend.get(key)
+        if fragment is not None:
+            self.hits += 1
+            return fragment
+        self.misses += 1
+        fragment = render()
+        self.backend.set(key, fragment)
+        return fragment
+
+    def stats(self):
+        return {'backend': self.backend.__class__.__name__,
+                'hits': self.hits, 'misses': self.misses}
+
+
+def load_backend(path, config):
+    '''Return a cache backend made by the factory at ``module:name``.
+
+    The factory is called with the site's config.
+
+    '''
+    (module_name, factory_name) = path.split(':')
+    module = __import__(module_name, fromlist=[factory_name])
+    return getattr(module, factory_name)(config)
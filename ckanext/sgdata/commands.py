@@ -1,14 +1,34 @@
 '''Paster commands provided by this extension.'''
 
+import collections
 import csv
 import datetime
+import hashlib
+import itertools
+import json
+import math
+import multiprocessing.pool
+import os.path
+import re
+import threading
+import time
 
 import ckanapi
+import paste.script.command
 import requests
+import requests.adapters
 
 import ckan.plugins.toolkit as toolkit
 import ckan.lib.cli
 
+import ckanext.sgdata.keywords as keywords
+import ckanext.sgdata.lookups as lookups
+import ckanext.sgdata.vocabularies as vocabularies
+
+
+# The CSV file that sgdataimport reads the datasets from.
+CSV_FILE = '3500_unclassified_metadata.csv'
+
 
 class SGDataImportCommand(ckan.lib.cli.CkanCommand):
 
@@ -17,6 +37,8 @@ class SGDataImportCommand(ckan.lib.cli.CkanCommand):
     Usage:
 
      paster sgdataimport <command> <url> <apikey> <organisation> [start_from]
+                         [--workers N] [--journal PATH] [--report PATH]
+                         [--site-url URL] [--report-missing]
 
     The possible commands are:
 
@@ -25,15 +47,35 @@ class SGDataImportCommand(ckan.lib.cli.CkanCommand):
 
      verify - For each dataset in the CSV file, verify that it exists in the
               CKAN site. Fetches the dataset from the CKAN API and checks that
-              its fields match the values from the CSV file. Also fetches the
-              dataset's HTML page just to check that it doesn't crash.
+              its fields match the values from the CSV file, and prints any
+              fields that don't. Also fetches the dataset's HTML page just to
+              check that it doesn't crash.
 
      import-and-verify - Import and verify each dataset.
 
+     delta - Bring the organisation's datasets up to date with the CSV file.
+             A hash of each dataset's contents is stored on the dataset when
+             it's imported. delta fetches the stored hashes with
+             package_search, creates the datasets that don't exist yet,
+             patches the ones whose hash has changed and doesn't write to the
+             ones that haven't changed at all. Fields that are blank in the
+             CSV file are cleared on the site, and the new hash is only
+             stored once the patched dataset matches the CSV file. Datasets
+             that have no hash, because they were last saved with the web
+             form, are compared field by field instead. With
+             --report-missing it also lists the organisation's datasets that
+             aren't in the CSV file.
+
      verify-api - Like verify, but does the API verification only.
 
      verify-html - Like verify, but does the HTML page verification only.
 
+     verify-search - Like verify-api, but fetches the organisation's datasets
+                     from CKAN's package_search API a page at a time instead
+                     of one by one. Rather than stopping at the first
+                     difference it writes a report of every missing or
+                     mismatched dataset to a JSON file.
+
     <apikey> is the API key of the user who will be used to post the datasets.
 
     <organisation> is the name of the organisation that the datasets will be
@@ -43,9 +85,30 @@ class SGDataImportCommand(ckan.lib.cli.CkanCommand):
     from (where 0 is the first row). This can be useful to continue a job where
     it left off.
 
+    --workers N (optional, default: 1) is the number of datasets to post to
+    CKAN at once when importing, or the number of dataset pages to fetch at
+    once for verify-html. Requests are made over a shared pool of keep-alive
+    connections and progress is still printed in CSV file order. verify-html
+    also prints the p50/p95/p99 page load times (of the request that
+    succeeded, if any were retried), the slowest pages and the number of
+    retried requests.
+
+    --site-url URL (optional, default: <url>) is the URL of the web site whose
+    dataset pages are checked by the verify commands.
+
+    --journal PATH (optional, default: sgdataimport-<organisation>.journal)
+    is the file that the outcome of each imported dataset is appended to by
+    the import, import-and-verify and delta commands (the verify commands
+    don't use it). When an import is run again, datasets that the journal
+    records as already created are skipped without contacting CKAN, so an
+    interrupted import can simply be restarted.
+
+    --report PATH (optional, default: sgdataimport-<organisation>-report.json)
+    is the file that verify-search writes its report to.
+
     Example:
 
-     paster sgdataimport import 'http://127.0.0.1:5000' aa1577ac-f19c-4a83-beb1-fe091caeace4 test-agency 840
+     paster sgdataimport import 'http://127.0.0.1:5000' aa1577ac-f19c-4a83-beb1-fe091caeace4 test-agency 840 --workers 8
 
     '''
 
@@ -54,6 +117,21 @@ class SGDataImportCommand(ckan.lib.cli.CkanCommand):
     min_args = 4
     max_args = 5
 
+    parser = paste.script.command.Command.standard_parser(verbose=True)
+    parser.add_option('-c', '--config', dest='config',
+                      default='development.ini', help='Config file to use.')
+    parser.add_option('--workers', dest='workers', type='int', default=1,
+                      help='Number of datasets to post at once.')
+    parser.add_option('--journal', dest='journal', default=None,
+                      help='File to record the progress of imports in.')
+    parser.add_option('--report', dest='report', default=None,
+                      help='File to write the verify-search report to.')
+    parser.add_option('--site-url', dest='site_url', default=None,
+                      help='URL of the site to verify the HTML pages of.')
+    parser.add_option('--report-missing', dest='report_missing',
+                      action='store_true', default=False,
+                      help="List datasets that aren't in the CSV file.")
+
     def command(self):
         '''Run the import datasets command.'''
         command = self.args[0]
@@ -64,84 +142,334 @@ class SGDataImportCommand(ckan.lib.cli.CkanCommand):
             start_from = int(self.args[4])
         else:
             start_from = 0
-
-        site = ckanapi.RemoteCKAN(url, apikey=apikey)
-        datasets = read_datasets_from_csv_file(
-            '3500_unclassified_metadata.csv', owner_org)
-
-        datasets = datasets[start_from:]
-
-        def post(site, dataset):
+        workers = max(self.options.workers, 1)
+        if command in ('import', 'import-and-verify', 'delta'):
+            journal = ImportJournal(
+                self.options.journal or
+                'sgdataimport-{0}.journal'.format(owner_org))
+        else:
+            journal = None
+
+        site_url = self.options.site_url or url
+        session = _http_session(workers)
+        site = ckanapi.RemoteCKAN(url, apikey=apikey, session=session)
+        datasets = read_datasets_from_csv_file(CSV_FILE, owner_org,
+                                               start_from)
+
+        def post(numbered_dataset):
+            (i, dataset) = numbered_dataset
+            if journal.is_completed(dataset['name']):
+                return "Dataset already imported {0}: {1}".format(
+                    i, _utf8(dataset['title']))
             try:
                 post_dataset(site, dataset)
-                print("Created dataset {0}: {1}".format(start_from+i,
-                                                        dataset['title']))
+                journal.record(i, dataset['name'], 'created')
+                return "Created dataset {0}: {1}".format(
+                    i, _utf8(dataset['title']))
             except DatasetAlreadyExistsError:
-                print("Dataset already exists {0}: {1}".format(
-                    start_from+i, dataset['title']))
+                journal.record(i, dataset['name'], 'exists')
+                return "Dataset already exists {0}: {1}".format(
+                    i, _utf8(dataset['title']))
+            except DatasetCreationError as err:
+                journal.record(i, dataset['name'], 'failed')
+                return "Dataset creation failed {0}: {1}: {2}".format(
+                    i, _utf8(dataset['title']), err)
+
+        def verify(i, dataset, web_ui):
+            try:
+                verify_dataset_via_api(site, dataset)
+            except DatasetVerificationError as err:
+                return "Dataset verification failed {0}: {1}: {2}".format(
+                    i, _utf8(dataset['title']), err)
+            if web_ui:
+                verify_dataset_via_web_ui(dataset, site_url, session)
+            return "Verified dataset {0}: {1}".format(
+                i, _utf8(dataset['title']))
 
         if command == 'import':
-            for (i, dataset) in enumerate(datasets):
-                post(site, dataset)
+            for message in imap_ordered(post, datasets, workers):
+                print(message)
+        elif command == 'delta':
+            existing = dict(
+                (dataset['name'], dataset) for dataset in
+                search_datasets(site, 'organization:{0}'.format(owner_org)))
+            clearable_fields = importable_fields(
+                read_fields_from_csv_file(CSV_FILE))
+            seen = set()
+
+            def apply_delta(numbered_dataset):
+                (i, dataset) = numbered_dataset
+                current = existing.get(dataset['name'])
+                if current is None:
+                    return post((i, dataset))
+                if current.get('import_hash') == dataset['import_hash']:
+                    return "Dataset unchanged {0}: {1}".format(
+                        i, _utf8(dataset['title']))
+                cleared_fields = [field for field in clearable_fields
+                                  if field not in dataset]
+                try:
+                    # Saving a dataset with the web form drops its
+                    # import_hash, so without one the fields are compared.
+                    if current.get('import_hash') is None and not (
+                            diff_dataset(dataset, current, cleared_fields)):
+                        store_import_hash(site, dataset)
+                        return "Dataset unchanged {0}: {1}".format(
+                            i, _utf8(dataset['title']))
+                    patch_dataset(site, dataset, cleared_fields)
+                    return "Updated dataset {0}: {1}".format(
+                        i, _utf8(dataset['title']))
+                except DatasetUpdateError as err:
+                    return "Dataset update failed {0}: {1}: {2}".format(
+                        i, _utf8(dataset['title']), err)
+
+            def remember(numbered_datasets):
+                for (i, dataset) in numbered_datasets:
+                    seen.add(dataset['name'])
+                    yield (i, dataset)
+
+            for message in imap_ordered(apply_delta, remember(datasets),
+                                        workers):
+                print(message)
+
+            if self.options.report_missing:
+                for name in sorted(set(existing) - seen):
+                    print("Dataset not in CSV file: {0}".format(name))
         elif command == 'verify':
-            for (i, dataset) in enumerate(datasets):
-                verify_dataset_via_api(site, dataset)
-                verify_dataset_via_web_ui(dataset)
-                print("Verified dataset {0}: {1}".format(start_from+i,
-                                                         dataset['title']))
+            for (i, dataset) in datasets:
+                print(verify(i, dataset, web_ui=True))
         elif command == 'import-and-verify':
-            for (i, dataset) in enumerate(datasets):
-                post(site, dataset)
-                verify_dataset_via_api(site, dataset)
-                verify_dataset_via_web_ui(dataset)
-                print("Verified dataset {0}: {1}".format(start_from+i,
-                                                         dataset['title']))
+            for (i, dataset) in datasets:
+                print(post((i, dataset)))
+                print(verify(i, dataset, web_ui=True))
         elif command == 'verify-api':
-            for (i, dataset) in enumerate(datasets):
-                verify_dataset_via_api(site, dataset)
-                print("Verified dataset {0}: {1}".format(start_from+i,
-                                                         dataset['title']))
+            for (i, dataset) in datasets:
+                print(verify(i, dataset, web_ui=False))
+        elif command == 'verify-search':
+            report = verify_datasets_via_search(
+                site, (dataset for (i, dataset) in datasets), owner_org)
+            report_path = (self.options.report or
+                           'sgdataimport-{0}-report.json'.format(owner_org))
+            with open(report_path, 'w') as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+            print("Verified {0} datasets: {1} matched, {2} missing, "
+                  "{3} mismatched, {4} unexpected. Report written to "
+                  "{5}".format(report['checked'], report['matched'],
+                               len(report['missing']),
+                               len(report['mismatched']),
+                               len(report['unexpected']), report_path))
         elif command == 'verify-html':
-            for (i, dataset) in enumerate(datasets):
-                verify_dataset_via_web_ui(dataset)
-                print("Verified dataset {0}: {1}".format(start_from+i,
-                                                         dataset['title']))
+            def verify_html(numbered_dataset):
+                (i, dataset) = numbered_dataset
+                try:
+                    (latency, retries) = verify_dataset_via_web_ui(
+                        dataset, site_url, session)
+                except (AssertionError,) + TRANSIENT_ERRORS:
+                    return (i, dataset, None, 0)
+                return (i, dataset, latency, retries)
+
+            timings = []
+            total_retries = 0
+            for (i, dataset, latency, retries) in imap_ordered(
+                    verify_html, datasets, workers):
+                if latency is None:
+                    print("Verifying dataset page failed {0}: {1}".format(
+                        i, _utf8(dataset['title'])))
+                    continue
+                timings.append((latency, dataset['name']))
+                total_retries += retries
+                if retries:
+                    print("Verified dataset {0}: {1} (after {2} "
+                          "retries)".format(
+                              i, _utf8(dataset['title']), retries))
+                else:
+                    print("Verified dataset {0}: {1}".format(
+                        i, _utf8(dataset['title'])))
+            print_latency_report(timings)
+            print("Retried {0} page requests".format(total_retries))
+
+        else:
+            print('Unknown command: {0}'.format(command))
+
+        if journal:
+            journal.close()
+
+
+class SGDataVocabularyCommand(ckan.lib.cli.CkanCommand):
+
+    '''Manage the vocabularies used by the dataset form.
+
+    Usage:
+
+     paster sgdatavocabs sync -c <config>
+
+    The possible commands are:
+
+     sync - Create any of the vocabularies or vocabulary tags that don't exist
+            in the database yet. All of the missing tags are added in one
+            transaction. This is also done when the plugin is loaded unless
+            ckanext.sgdata.sync_vocabularies_on_startup is false.
+
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    min_args = 1
+    max_args = 1
+
+    def command(self):
+        '''Run the vocabularies command.'''
+        self._load_config()
+
+        command = self.args[0]
+        if command == 'sync':
+            added = vocabularies.sync()
+            for (vocab, tag) in added:
+                print("Added tag {0} to vocabulary {1}".format(tag, vocab))
+            print("Added {0} tags".format(len(added)))
+        else:
+            print('Unknown command: {0}'.format(command))
+
+
+class SGDataSearchCommand(ckan.lib.cli.CkanCommand):
+
+    '''Manage the sgdata fields in the search index.
+
+    Usage:
+
+     paster sgdatasearch reindex [dataset] -c <config>
+
+    The possible commands are:
+
+     reindex - Reindex every active dataset (or just [dataset], a dataset
+               name or id) so that the sgdata_* category, department and
+               vocabulary fields used by the search facets are filled in.
+               Datasets are sent to the search engine as they're read and
+               committed once at the end, rather than once per dataset.
+
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    min_args = 1
+    max_args = 2
+
+    def command(self):
+        '''Run the search index command.'''
+        self._load_config()
 
+        command = self.args[0]
+        if command == 'reindex':
+            self.reindex(self.args[1] if len(self.args) == 2 else None)
         else:
             print('Unknown command: {0}'.format(command))
 
+    def reindex(self, dataset=None):
+        import ckan.model as model
+        import ckan.lib.search as search
+
+        if dataset:
+            package_ids = [toolkit.get_action('package_show')(
+                {'ignore_auth': True}, {'id': dataset})['id']]
+        else:
+            package_ids = [package_id for (package_id,) in
+                           model.Session.query(model.Package.id).filter(
+                               model.Package.state == 'active')]
+
+        package_index = search.index_for(model.Package)
+        failed = []
+        for (i, package_id) in enumerate(package_ids, 1):
+            context = {'model': model, 'session': model.Session,
+                       'ignore_auth': True, 'validate': False,
+                       'use_cache': False}
+            try:
+                pkg_dict = toolkit.get_action('package_show')(
+                    context, {'id': package_id})
+                package_index.update_dict(pkg_dict, defer_commit=True)
+            except Exception as e:
+                failed.append(package_id)
+                print("Failed to index {0}: {1}".format(package_id, e))
+            if i % 100 == 0:
+                print("Indexed {0} of {1} datasets".format(
+                    i, len(package_ids)))
+        package_index.commit()
+
+        print("Indexed {0} datasets, {1} failed".format(
+            len(package_ids) - len(failed), len(failed)))
+
+
+# The column headers of the CSV file that don't simply map to a field name by
+# lower-casing them and replacing spaces with underscores.
+HEADER_TRANSLATIONS = {
+    'SG-DATA RECORD IDENTIFIER': 'sg_data_record_identifier',
+    'REFERENCE PERIOD FROM': 'reference-period-start',
+    'REFERENCE PERIOD TO': 'reference-period-end',
+    'AGENCY RECORD IDENTIFIER': 'agency_record_identifier',
+    '1ST LEVEL CATEGORY NUMBER (2-DIGITS)*': 'first_level_category',
+    '2ND LEVEL CATEGORY NUMBER (2-DIGITS)*': 'second_level_category',
+    '3RD LEVEL CATEGORY NUMBER (2-DIGITS)*': 'third_level_category',
+    "SURVEY/ADMINISTRATIVE SOURCE (COMPULSORY IF TYPE OF DATA COLLECTION IS NOT 'OT')": 'zzz_administrative_source',
+    'DATA PROVIDER/DISTRIBUTOR*': 'data_provider',
+    'ALTERNATE PROVIDER NAME*': 'data_provider_alternate_contact_name',
+    'ALTERNATE PROVIDER DESIGNATION*': 'data_provider_alternate_contact_designation',
+    'ALTERNATE PROVIDER DEPARTMENT*': 'data_provider_alternate_contact_department',
+    'ALTERNATE PROVIDER TELEPHONE NUMBER*': 'data_provider_alternate_contact_telephone_number',
+    'ALTERNATE PROVIDER EMAIL ADDRESS*': 'data_provider_alternate_contact_email_address',
+    'DATA COMPILER/SOURCE': 'data_compiler',
+    'COMPILER NAME': 'data_compiler_contact_name',
+    'COMPILER DESIGNATION': 'data_compiler_contact_designation',
+    'COMPILER DEPARTMENT': 'data_compiler_contact_department',
+    'COMPILER TELEPHONE NUMBER': 'data_compiler_contact_telephone_number',
+    'COMPILER EMAIL ADDRESS': 'data_compiler_contact_email_address',
+    'PUBLISH DATAGOVSG': 'publish_on_data_gov_sg',
+    'METADATA AVAILABILITY DATE': 'available-from',
+    'DATA PROVIDER EMAIL*': 'data_provider_contact_email_address',
+    }
+
+
+class SGDataExportCommand(ckan.lib.cli.CkanCommand):
+
+    '''Export datasets from CKAN to a CSV file that sgdataimport can import.
+
+    Usage:
+
+     paster sgdataexport <url> <apikey> <path> [organisation]
+
+    The datasets are fetched from CKAN's package_search API a page at a time
+    and written to the CSV file at <path> as they're fetched, using the same
+    columns and codes as 3500_unclassified_metadata.csv.
+
+    [organisation] (optional) is the name of the organisation to export the
+    datasets of. By default all datasets are exported.
+
+    '''
+
+    summary = __doc__.split('\n')[0]
+    usage = __doc__
+    min_args = 3
+    max_args = 4
+
+    def command(self):
+        '''Run the export datasets command.'''
+        url = self.args[0]
+        apikey = self.args[1]
+        path = self.args[2]
+        if len(self.args) == 4:
+            fq = 'organization:{0}'.format(self.args[3])
+        else:
+            fq = ''
+
+        site = ckanapi.RemoteCKAN(url, apikey=apikey,
+                                  session=_http_session(1))
+        count = write_datasets_to_csv_file(search_datasets(site, fq), path)
+        print("Exported {0} datasets to {1}".format(count, path))
+
 
 def read_headers_from_csv_fow(row):
-    header_translations = {
-        'SG-DATA RECORD IDENTIFIER': 'sg_data_record_identifier',
-        'REFERENCE PERIOD FROM': 'reference-period-start',
-        'REFERENCE PERIOD TO': 'reference-period-end',
-        'AGENCY RECORD IDENTIFIER': 'agency_record_identifier',
-        '1ST LEVEL CATEGORY NUMBER (2-DIGITS)*': 'first_level_category',
-        '2ND LEVEL CATEGORY NUMBER (2-DIGITS)*': 'second_level_category',
-        '3RD LEVEL CATEGORY NUMBER (2-DIGITS)*': 'third_level_category',
-        "SURVEY/ADMINISTRATIVE SOURCE (COMPULSORY IF TYPE OF DATA COLLECTION IS NOT 'OT')": 'zzz_administrative_source',
-        'DATA PROVIDER/DISTRIBUTOR*': 'data_provider',
-        'ALTERNATE PROVIDER NAME*': 'data_provider_alternate_contact_name',
-        'ALTERNATE PROVIDER DESIGNATION*': 'data_provider_alternate_contact_designation',
-        'ALTERNATE PROVIDER DEPARTMENT*': 'data_provider_alternate_contact_department',
-        'ALTERNATE PROVIDER TELEPHONE NUMBER*': 'data_provider_alternate_contact_telephone_number',
-        'ALTERNATE PROVIDER EMAIL ADDRESS*': 'data_provider_alternate_contact_email_address',
-        'DATA COMPILER/SOURCE': 'data_compiler',
-        'COMPILER NAME': 'data_compiler_contact_name',
-        'COMPILER DESIGNATION': 'data_compiler_contact_designation',
-        'COMPILER DEPARTMENT': 'data_compiler_contact_department',
-        'COMPILER TELEPHONE NUMBER': 'data_compiler_contact_telephone_number',
-        'COMPILER EMAIL ADDRESS': 'data_compiler_contact_email_address',
-        'PUBLISH DATAGOVSG': 'publish_on_data_gov_sg',
-        'METADATA AVAILABILITY DATE': 'available-from',
-        'DATA PROVIDER EMAIL*': 'data_provider_contact_email_address',
-        }
     headers = []
     for header in row:
         header = header.strip()
-        if header in header_translations:
-            header = header_translations[header]
+        if header in HEADER_TRANSLATIONS:
+            header = HEADER_TRANSLATIONS[header]
         else:
             if header.endswith('*'):
                 header = header[:-1]
@@ -151,179 +479,744 @@ def read_headers_from_csv_fow(row):
     return headers
 
 
-def read_datasets_from_csv_file(path, owner_org):
+# How each field of the CSV file is imported, after its header has been
+# turned into a field name by read_headers_from_csv_fow():
+#
+# - The category level fields are combined into one category code by
+#   _category_from_row(), then dropped along with the other DROPPED_FIELDS.
+# - Empty values are dropped.
+# - The codes in the CODE_TRANSLATIONS fields are translated into the
+#   vocabulary tags they stand for, as defined in the plugin's vocabularies.
+# - The DATE_FIELDS are converted from CSV_DATE_FORMAT to SITE_DATE_FORMAT.
+# - Every other field is imported as it is.
+#
+# compile_transform() turns these rules into one function per CSV file.
+CODE_TRANSLATIONS = dict((name, dict(codes)) for (name, codes)
+                         in vocabularies.VOCABULARY_CODES)
 
-    print("Reading CSV file...")
-    datasets = []
-    headers = None
-    datasets_skipped_because_no_administrative_source = 0
-    datasets_skipped_because_invalid_category = 0
-    for row in csv.reader(open(path, 'r')):
-        if not headers:
-            headers = read_headers_from_csv_fow(row)
-        else:
+# The CSV file's code for each vocabulary tag, for exporting datasets.
+TAG_CODES = dict((name, dict((tag, code) for (code, tag) in codes))
+                 for (name, codes) in vocabularies.VOCABULARY_CODES)
+
+DATE_FIELDS = ('reference-period-start', 'reference-period-end',
+               'available-from')
+
+CSV_DATE_FORMAT = '%Y%m%d'
+
+SITE_DATE_FORMAT = '%m/%d/%Y'
+
+DROPPED_FIELDS = (
+    'first_level_category',
+    'second_level_category',
+    'third_level_category',
+    # We're not using resources/data file URLs on this site.
+    'data_provider_url',
+    )
+
+
+class InvalidRowError(Exception):
+
+    '''A row of the CSV file has a value that can't be imported.'''
+
+    def __init__(self, line_number, message):
+        Exception.__init__(self, 'Line {0}: {1}'.format(line_number, message))
+        self.line_number = line_number
+
+
+def _utf8(value):
+    '''Return a value from a dataset as UTF-8 bytes, for printing.'''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def read_fields_from_csv_file(path):
+    '''Return the field names of the columns of a CSV file.'''
+    with open(path, 'r') as f:
+        return read_headers_from_csv_fow(next(csv.reader(f)))
+
+
+def importable_fields(fields):
+    '''Return the dataset fields that are set from the given CSV fields.
+
+    These are the fields that are left out of a dataset dict when they're
+    blank in its row, as opposed to the fields that are dropped, combined or
+    renamed.
+
+    '''
+    return [field for field in fields if field not in DROPPED_FIELDS
+            and field not in ('sg_data_record_identifier', 'keywords')]
+
+
+def read_rows_from_csv_file(path):
+    '''Yield the line number and a dict of the stripped values of each row.
+
+    The rows are read lazily, one at a time. The CSV file is UTF-8 and the
+    values are decoded to unicode, so they compare equal to the values that
+    the CKAN API returns. Raises :py:class:`InvalidRowError` if a row isn't
+    valid UTF-8.
+
+    '''
+    with open(path, 'r') as f:
+        reader = csv.reader(f)
+        headers = read_headers_from_csv_fow(next(reader))
+        for row in reader:
             data = {}
             for header, value in zip(headers, row):
-                data[header] = value.strip()
-
-            data['category'] = '{0}.{1:02}'.format(
-                int(data['first_level_category']),
-                int(data['second_level_category']))
-            del data['first_level_category']
-            del data['second_level_category']
-            del data['third_level_category']
-
-            if data['category'] in ('10.10', '13.23', '16.16'):
-                datasets_skipped_because_invalid_category += 1
-                continue
-
-            for key in data.keys():
-                if not data[key]:
-                    del data[key]
-
-            if 'zzz_administrative_source' not in data:
-                datasets_skipped_because_no_administrative_source += 1
-                continue
-
-            if 'type_of_data_collection' in data:
-                data['type_of_data_collection'] = {
-                    'AD': 'Administrative Data Collection',
-                    'SD': 'Survey Data Collection',
-                    'MX': 'Mix of Survey and Administrative Data Collection',
-                    'O': 'Others',
-                    }[data['type_of_data_collection']]
-
-            if 'frequency' in data:
-                data['frequency'] = {
-                    'A': 'Annually',
-                    'O': 'Others',
-                    'D': 'Daily',
-                    'W': 'Weekly',
-                    'M': 'Monthly',
-                    'Q': 'Quarterly',
-                    'H': 'Half Yearly',
-                    'C': 'Ad-Hoc',
-                    }[data['frequency']]
-
-            if 'security_classification' in data:
-                data['security_classification'] = {
-                    'U': 'Unclassified',
-                    'R': 'Restricted',
-                    'C': 'Confidential',
-                    'S': 'Secret',
-                    }[data['security_classification']]
-
-            if 'data_granularity' in data:
-                data['data_granularity'] = {
-                    'AD': 'Aggregated Data',
-                    'IR': 'Individual Record',
-                }[data['data_granularity']]
-
-            if 'publish_on_data_gov_sg' in data:
-                data['publish_on_data_gov_sg'] = {
-                    '0': 'No',
-                    '1': 'Yes - publish both metadata and data',
-                    '2': 'Yes - publish metadata only',
-                }[data['publish_on_data_gov_sg']]
-
-            if 'status' in data:
-                data['status'] = {
-                    'A': 'Active',
-                    'D': 'Discontinued',
-                    'R': 'Replaced',
-                    'TBC': 'To be Collected',
-                    }[data['status']]
-
-            data['title'] = data['title'].replace('\xc2\xa0', '').replace(
-                '\xc2\xbf', '')
-
-            def keyword_translate(keyword):
-                '''Transform string into a valid CKAN tag name.'''
-                translated_keyword = ''
-                for char in keyword:
-                    if char.isalnum() or char in '-._ ':
-                        translated_keyword = translated_keyword + char
-                return translated_keyword
-            keywords = [keyword_translate(keyword.strip())
-                        for keyword in data.get('keywords').split(',')
-                        if keyword.strip()]
-            data['tags'] = [{'name': keyword} for keyword in set(keywords)]
-            del data['keywords']
-
-            data['name'] = data['sg_data_record_identifier'].lower().strip()
-            del data['sg_data_record_identifier']
-
-            data['owner_org'] = owner_org
-
-            # We're not using resources/data file URLs on this site.
-            if 'data_provider_url' in data:
-                del data['data_provider_url']
-
-            for key in ('reference-period-start', 'reference-period-end',
-                        'available-from'):
-                if key in data:
-                    data[key] = datetime.datetime.strptime(data[key], '%Y%m%d').strftime('%m/%d/%Y')
-
-            datasets.append(data)
+                try:
+                    data[header] = value.decode('utf-8').strip()
+                except UnicodeDecodeError:
+                    raise InvalidRowError(reader.line_num, (
+                        "{0} is not valid UTF-8: {1!r}").format(header, value))
+            yield (reader.line_num, data)
+
+
+def _category_from_row(data, line_number):
+    '''Return the category code of a row from the CSV file.
+
+    This is the row's third-level category code if it has one that's in
+    categories.json, otherwise its second-level code. Raises
+    :py:class:`InvalidRowError` if the row's first or second level number is
+    missing or isn't a number.
+
+    '''
+    try:
+        category = '{0}.{1:02}'.format(int(data['first_level_category']),
+                                       int(data['second_level_category']))
+    except (KeyError, ValueError):
+        raise InvalidRowError(line_number, (
+            "invalid category numbers '{0}' and '{1}'").format(
+                _utf8(data.get('first_level_category', '')),
+                _utf8(data.get('second_level_category', ''))))
+    third_level = data.get('third_level_category')
+    if third_level and third_level.isdigit() and int(third_level):
+        third_level_category = '{0}.{1:02}'.format(category, int(third_level))
+        if third_level_category in lookups.categories.get().by_code:
+            return third_level_category
+    return category
+
+
+def filter_rows(rows, skipped):
+    '''Yield only the rows that can be imported.
+
+    This only does the checks needed to decide whether a row should be
+    skipped, not the full transformation. The number of rows skipped for each
+    reason is counted in the skipped dict. Rows whose category numbers
+    can't be read are reported with their line number.
+
+    '''
+    for (line_number, data) in rows:
+        try:
+            category = _category_from_row(data, line_number)
+        except InvalidRowError as e:
+            skipped['invalid category'] += 1
+            print("Skipping row: {0}".format(e))
+            continue
+        if category not in lookups.categories.get().by_code:
+            skipped['invalid category'] += 1
+            continue
+
+        if not data.get('zzz_administrative_source'):
+            skipped['no administrative source'] += 1
+            continue
+
+        yield (line_number, data)
+
+
+def compile_transform(fields, owner_org):
+    '''Return a function that transforms rows with the given fields.
+
+    Which of the rules above apply to which fields is worked out once here,
+    for the fields in the CSV file's header, so transforming each row only
+    runs the steps that its fields need.
+
+    The returned function takes a row's dict and its line number and returns
+    a dataset dict for CKAN. It raises :py:class:`InvalidRowError` if the row
+    has an unknown code or an invalid date.
+
+    '''
+    dropped = [field for field in fields if field in DROPPED_FIELDS]
+    codes = [(field, CODE_TRANSLATIONS[field]) for field in fields
+             if field in CODE_TRANSLATIONS]
+    dates = [field for field in fields if field in DATE_FIELDS]
+
+    def transform(data, line_number):
+        data['category'] = _category_from_row(data, line_number)
+        for field in dropped:
+            data.pop(field, None)
+
+        for key in data.keys():
+            if not data[key]:
+                del data[key]
+
+        for (field, table) in codes:
+            if field in data:
+                try:
+                    data[field] = table[data[field]]
+                except KeyError:
+                    raise InvalidRowError(line_number, (
+                        "unknown {0} code '{1}', expected one of: "
+                        "{2}").format(field, _utf8(data[field]),
+                                      ', '.join(sorted(table))))
+
+        for field in dates:
+            if field in data:
+                try:
+                    data[field] = datetime.datetime.strptime(
+                        data[field], CSV_DATE_FORMAT).strftime(
+                            SITE_DATE_FORMAT)
+                except ValueError:
+                    raise InvalidRowError(line_number, (
+                        "invalid {0} date '{1}', expected "
+                        "YYYYMMDD").format(field, _utf8(data[field])))
+
+        if 'sg_data_record_identifier' not in data:
+            raise InvalidRowError(line_number, "no SG-DATA RECORD IDENTIFIER")
+        data['name'] = data.pop('sg_data_record_identifier').lower().strip()
+
+        if 'title' in data:
+            data['title'] = data['title'].replace(u'\xa0', '').replace(
+                u'\xbf', '')
+
+        data['tags'] = [{'name': tag} for tag in keywords.normalise_tags(
+            data.pop('keywords', '').split(','))]
+
+        data['owner_org'] = owner_org
+
+        data['import_hash'] = dataset_hash(data)
+
+        return data
+
+    return transform
+
+
+def dataset_hash(dataset):
+    '''Return a hash of the contents of a dataset read from the CSV file.
+
+    The hash doesn't depend on the order of the dataset's tags, and ignores
+    any import_hash that the dataset already has. json.dumps() escapes
+    non-ASCII characters, so the hash of a dataset with unicode values is the
+    same as when the values were UTF-8 byte strings.
+
+    '''
+    canonical = dict(dataset)
+    canonical.pop('import_hash', None)
+    canonical['tags'] = sorted(tag['name'] for tag in dataset.get('tags', []))
+    return hashlib.sha1(json.dumps(canonical, sort_keys=True)).hexdigest()
+
+
+def read_datasets_from_csv_file(path, owner_org, start_from=0):
+    '''Yield the row number and dataset of each dataset in the CSV file.
+
+    This is a generator pipeline: rows are read, filtered and transformed one
+    at a time as the datasets are consumed, so memory use doesn't grow with the
+    size of the file.
+
+    The row numbers count the rows that passed filter_rows(), from 0. The
+    first start_from of them are skipped without being transformed, so a
+    printed row number can be given as start_from to resume from that
+    dataset. Rows with values that can't be imported are reported with their
+    line number and skipped, but still counted, so the row numbers of the
+    datasets after them don't change.
+
+    '''
+    print("Reading CSV file...")
+    transform = compile_transform(read_fields_from_csv_file(path), owner_org)
+
+    skipped = collections.defaultdict(int)
+    rows = filter_rows(read_rows_from_csv_file(path), skipped)
+    numbered_rows = itertools.islice(enumerate(rows), start_from, None)
+    for (i, (line_number, data)) in numbered_rows:
+        try:
+            dataset = transform(data, line_number)
+        except InvalidRowError as e:
+            skipped['invalid value'] += 1
+            print("Skipping dataset {0}: {1}".format(i, e))
+            continue
+        yield (i, dataset)
 
     print('Skipped {0} datasets because no administrative source'.format(
-        datasets_skipped_because_no_administrative_source))
+        skipped['no administrative source']))
     print('Skipped {0} datasets because invalid category'.format(
-        datasets_skipped_because_invalid_category))
-    return datasets
+        skipped['invalid category']))
+    print('Skipped {0} datasets because invalid value'.format(
+        skipped['invalid value']))
+
+
+# The fields written to each row of an exported CSV file, in column order.
+EXPORT_FIELDS = (
+    'sg_data_record_identifier',
+    'title',
+    'notes',
+    'first_level_category',
+    'second_level_category',
+    'third_level_category',
+    'keywords',
+    'type_of_data_collection',
+    'status',
+    'frequency',
+    'security_classification',
+    'data_granularity',
+    'publish_on_data_gov_sg',
+    'reference-period-start',
+    'reference-period-end',
+    'available-from',
+    'zzz_administrative_source',
+    'coverage',
+    'conditions_of_use',
+    'unit_of_measure',
+    'data_provider',
+    'data_provider_contact_name',
+    'data_provider_contact_designation',
+    'data_provider_contact_department',
+    'data_provider_contact_telephone_number',
+    'data_provider_contact_email_address',
+    'data_provider_alternate_contact_name',
+    'data_provider_alternate_contact_designation',
+    'data_provider_alternate_contact_department',
+    'data_provider_alternate_contact_telephone_number',
+    'data_provider_alternate_contact_email_address',
+    'data_compiler',
+    'data_compiler_contact_name',
+    'data_compiler_contact_designation',
+    'data_compiler_contact_department',
+    'data_compiler_contact_telephone_number',
+    'data_compiler_contact_email_address',
+    'agency_record_identifier',
+    'department',
+    'comments',
+    'purpose',
+    )
+
+
+def export_header(field):
+    '''Return the CSV column header that the importer reads as field.'''
+    for (header, translation) in HEADER_TRANSLATIONS.items():
+        if translation == field:
+            return header
+    return field.upper()
+
+
+def dataset_to_row(dataset):
+    '''Transform a dataset dict from the CKAN API into a row for the CSV file.
+
+    This is the reverse of compile_transform(): vocabulary values are turned
+    back into their codes, dates back into YYYYMMDD and the category back
+    into its first and second level numbers.
+
+    '''
+    data = dict((field, dataset.get(field) or '') for field in EXPORT_FIELDS)
+
+    data['sg_data_record_identifier'] = dataset['name']
+
+    if dataset.get('category'):
+        levels = dataset['category'].split('.')
+        data['first_level_category'] = '{0:02}'.format(int(levels[0]))
+        data['second_level_category'] = levels[1]
+        if len(levels) > 2:
+            data['third_level_category'] = levels[2]
+
+    data['keywords'] = ', '.join(sorted(tag['name']
+                                        for tag in dataset.get('tags', [])))
+
+    for (field, codes) in TAG_CODES.items():
+        if data[field]:
+            data[field] = codes.get(data[field], data[field])
+
+    for key in DATE_FIELDS:
+        if data[key]:
+            data[key] = datetime.datetime.strptime(
+                data[key], SITE_DATE_FORMAT).strftime(CSV_DATE_FORMAT)
+
+    row = []
+    for field in EXPORT_FIELDS:
+        value = data[field]
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        row.append(value)
+    return row
+
+
+def write_datasets_to_csv_file(datasets, path):
+    '''Write datasets to a CSV file in the layout that the importer reads.
+
+    The datasets are written one at a time as they're read from the datasets
+    iterable, so this can export any number of datasets in constant memory.
+    Returns the number of datasets written.
+
+    '''
+    count = 0
+    with open(path, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow([export_header(field) for field in EXPORT_FIELDS])
+        for dataset in datasets:
+            writer.writerow(dataset_to_row(dataset))
+            count += 1
+    return count
+
+
+# Errors that are worth retrying a request after.
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout)
+
+# The HTTP statuses of responses that are worth retrying a request after,
+# usually from a proxy in front of a CKAN site that's restarting or busy.
+TRANSIENT_STATUSES = (502, 503, 504)
+
+
+def _http_session(pool_size):
+    '''Return a requests session that keeps up to pool_size connections.'''
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                            pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def imap_ordered(func, items, workers):
+    '''Like itertools.imap() but calls func from a pool of worker threads.
+
+    The results are yielded in the same order as items. Only a few items per
+    worker are read from items ahead of the result being yielded, so items can
+    be a generator of any length.
+
+    '''
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    pool = multiprocessing.pool.ThreadPool(workers)
+    try:
+        pending = collections.deque()
+        for item in items:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def _http_status(err):
+    '''Return the HTTP status of a CKANAPIError, or None if it has none.
+
+    ckanapi raises responses that aren't CKAN API errors, like a proxy's
+    error page, as ``CKANAPIError(repr([url, status, response]))``.
+
+    '''
+    match = re.match(r"\[u?'[^']*', (\d{3}),", str(err))
+    if match:
+        return int(match.group(1))
+    return None
+
+
+def is_transient(err):
+    '''Return True if a request that raised err is worth retrying.'''
+    if isinstance(err, TRANSIENT_ERRORS):
+        return True
+    return (isinstance(err, ckanapi.errors.CKANAPIError)
+            and _http_status(err) in TRANSIENT_STATUSES)
+
+
+def with_retries(func, retries=5, backoff=1):
+    '''Call func, retrying with exponential backoff on transient errors.'''
+    for attempt in range(retries + 1):
+        try:
+            return func()
+        except TRANSIENT_ERRORS + (ckanapi.errors.CKANAPIError,) as err:
+            if attempt == retries or not is_transient(err):
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+class ImportJournal(object):
+
+    '''An append-only log of the outcome of importing each dataset.
+
+    Each line of the file records the row number, dataset name and outcome
+    (created, exists or failed) of one dataset, and is flushed to disk as soon
+    as it's written. Lines can be recorded from several worker threads at once
+    and in any order, since a restarted import only needs to know the set of
+    datasets that were completed, not how far through the file it got.
+
+    '''
+
+    COMPLETED_OUTCOMES = ('created', 'exists')
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = self._read_completed()
+        self._file = open(path, 'a+')
+        self._lock = threading.Lock()
+
+        # End a partially written last line left by a crash, so that the
+        # next line isn't appended to it.
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell():
+            self._file.seek(-1, os.SEEK_END)
+            if self._file.read(1) != '\n':
+                self._file.seek(0, os.SEEK_END)
+                self._file.write('\n')
+                self._file.flush()
+
+    def _read_completed(self):
+        completed = set()
+        if not os.path.exists(self.path):
+            return completed
+        with open(self.path, 'r') as f:
+            for line in f:
+                # Ignore a partially written last line left by a crash.
+                if not line.endswith('\n'):
+                    continue
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) == 3 and fields[2] in self.COMPLETED_OUTCOMES:
+                    completed.add(fields[1])
+        return completed
+
+    def is_completed(self, name):
+        return name in self.completed
+
+    def record(self, row, name, outcome):
+        with self._lock:
+            self._file.write('{0}\t{1}\t{2}\n'.format(row, name, outcome))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            if outcome in self.COMPLETED_OUTCOMES:
+                self.completed.add(name)
+
+    def close(self):
+        self._file.close()
 
 
 class DatasetAlreadyExistsError(Exception):
     pass
 
 
+class DatasetCreationError(Exception):
+    pass
+
+
+class DatasetUpdateError(Exception):
+    pass
+
+
+class DatasetVerificationError(Exception):
+    pass
+
+
 def post_dataset(site, dataset):
+    attempts = []
+
+    def create():
+        attempts.append(True)
+        return site.action.package_create(**dataset)
+
     try:
-        site.action.package_create(**dataset)
+        with_retries(create)
     except toolkit.ValidationError as err:
         if err.error_dict == {'URL': ['That URL is already in use.'],
                               '__type': 'Validation Error'}:
             raise DatasetAlreadyExistsError
+        elif len(attempts) > 1 and ('That URL is already in use.' in
+                                    err.error_dict.get('URL', [])):
+            # An earlier attempt that failed with a timeout or a 5xx response
+            # created the dataset after all.
+            raise DatasetAlreadyExistsError
         else:
-            print("Dataset creation failed: {0}".format(dataset['title']))
-            import ipdb; ipdb.set_trace()
-    except ckanapi.errors.CKANAPIError as err:
-        print("Dataset creation failed: {0}".format(dataset['title']))
-        import ipdb; ipdb.set_trace()
+            raise DatasetCreationError(err.error_dict)
+    except (ckanapi.errors.CKANAPIError,) + TRANSIENT_ERRORS as err:
+        raise DatasetCreationError(err)
 
 
-def verify_dataset_via_api(site, dataset):
+def _patch(site, data_dict):
+    try:
+        return with_retries(lambda: site.action.package_patch(**data_dict))
+    except toolkit.ValidationError as err:
+        raise DatasetUpdateError(err.error_dict)
+    except (ckanapi.errors.CKANAPIError,) + TRANSIENT_ERRORS as err:
+        raise DatasetUpdateError(err)
+
+
+def store_import_hash(site, dataset):
+    '''Store the import_hash of a dataset from the CSV file on the site.'''
+    _patch(site, {'id': dataset['name'],
+                  'import_hash': dataset['import_hash']})
+
+
+def patch_dataset(site, dataset, cleared_fields=()):
+    '''Update a dataset on the site to match a dataset from the CSV file.
+
+    cleared_fields are the fields that are blank in the CSV file, which are
+    left out of the dataset dict. They're sent as '' so that the site's old
+    values are cleared.
+
+    The dataset's import_hash is only stored once the updated dataset has
+    been checked against the CSV file, so an update that doesn't take effect
+    is tried again by the next delta.
 
-    dataset_from_api = site.action.package_show(id=dataset['name'])
+    '''
+    data_dict = dict(dataset, id=dataset['name'])
+    del data_dict['import_hash']
+    for field in cleared_fields:
+        data_dict[field] = ''
+    updated = _patch(site, data_dict)
+    differences = diff_dataset(dataset, updated, cleared_fields)
+    if differences:
+        raise DatasetUpdateError(format_differences(differences))
+    store_import_hash(site, dataset)
+
+
+def diff_dataset(dataset, dataset_from_api, cleared_fields=()):
+    '''Return a list of the fields that differ between two dataset dicts.
+
+    dataset is a dataset read from the CSV file and dataset_from_api is the
+    same dataset as returned by the CKAN API. Each difference is a dict with
+    the name of the field and the expected and actual values (None if the
+    field is missing from the API's dataset). The cleared_fields, which are
+    blank in the CSV file, are expected to be blank or missing.
+
+    The values are compared as they are, so both datasets need unicode
+    values: read_rows_from_csv_file() decodes the CSV file for this.
+
+    '''
+    differences = []
     for key in dataset.keys():
 
+        if key in ('owner_org', 'sg_data_record_identifier', 'import_hash'):
+            continue
+
         if key == 'tags':
-            tags_from_api = [{'name': tag['name']}
-                             for tag in dataset_from_api['tags']]
-            tags_from_api.sort()
-            dataset['tags'].sort()
-            if tags_from_api != dataset['tags']:
-                import ipdb; ipdb.set_trace()
+            expected = sorted(tag['name'] for tag in dataset['tags'])
+            actual = sorted(tag['name']
+                            for tag in dataset_from_api.get('tags', []))
+        else:
+            expected = dataset[key]
+            actual = dataset_from_api.get(key)
+
+        if expected != actual:
+            differences.append({'field': key, 'expected': expected,
+                                'actual': actual})
+
+    for key in cleared_fields:
+        if dataset_from_api.get(key):
+            differences.append({'field': key, 'expected': '',
+                                'actual': dataset_from_api[key]})
+    return differences
+
+
+def format_differences(differences):
+    '''Return a one-line description of a list from diff_dataset().'''
+    return '; '.join('{0}: expected {1!r}, got {2!r}'.format(
+        difference['field'], difference['expected'], difference['actual'])
+        for difference in differences)
+
 
-        elif key == 'owner_org':
-            pass
+def verify_dataset_via_api(site, dataset):
+    '''Check that a dataset on the site matches the one from the CSV file.
+
+    Raises DatasetVerificationError with the differences if it doesn't.
+
+    '''
+    dataset_from_api = with_retries(
+        lambda: site.action.package_show(id=dataset['name']))
+    differences = diff_dataset(dataset, dataset_from_api)
+    if differences:
+        raise DatasetVerificationError(format_differences(differences))
 
-        elif key == 'title':
-            if dataset['title'] != dataset_from_api['title']:
-                import ipdb; ipdb.set_trace()
 
-        elif key == 'sg_data_record_identifier':
-            pass
+def search_datasets(site, fq, rows=1000):
+    '''Yield every dataset matching a package_search filter query.
+
+    The datasets are fetched rows at a time, in order of name.
+
+    '''
+    start = 0
+    while True:
+        result = with_retries(lambda: site.action.package_search(
+            fq=fq, rows=rows, start=start, sort='name asc'))
+        for dataset in result['results']:
+            yield dataset
+        start += rows
+        if not result['results'] or start >= result['count']:
+            break
+
+
+def verify_datasets_via_search(site, datasets, owner_org):
+    '''Verify many datasets against the CKAN API at once.
+
+    Rather than fetching each dataset with its own package_show call, all of
+    the organisation's datasets are fetched in pages from package_search and
+    compared in memory with the datasets from the CSV file.
+
+    Returns a report dict listing the datasets that are missing from the site,
+    the ones whose fields don't match the CSV file, and the ones in the
+    organisation on the site that aren't in the CSV file at all. Datasets
+    with non-ASCII values match as long as they were read with
+    read_datasets_from_csv_file(), which decodes them to unicode.
 
+    '''
+    datasets_from_api = dict(
+        (dataset['name'], dataset) for dataset in
+        search_datasets(site, 'organization:{0}'.format(owner_org)))
+
+    report = {'checked': 0, 'matched': 0, 'missing': [], 'mismatched': {},
+              'unexpected': []}
+    for dataset in datasets:
+        report['checked'] += 1
+        dataset_from_api = datasets_from_api.pop(dataset['name'], None)
+        if dataset_from_api is None:
+            report['missing'].append(dataset['name'])
+            continue
+        differences = diff_dataset(dataset, dataset_from_api)
+        if differences:
+            report['mismatched'][dataset['name']] = differences
         else:
-            try:
-                if dataset_from_api[key] != dataset[key]:
-                    import ipdb; ipdb.set_trace()
-            except KeyError as err:
-                import ipdb; ipdb.set_trace()
+            report['matched'] += 1
+    report['unexpected'] = sorted(datasets_from_api)
+    return report
+
+
+def verify_dataset_via_web_ui(dataset, site_url='http://127.0.0.1:5000',
+                              session=requests):
+    '''Fetch a dataset's HTML page and check that it doesn't crash.
+
+    Returns the time the page took to load, in seconds, and the number of
+    times the request was retried. Only the attempt that succeeded is timed,
+    not the failed attempts or the waits between them.
+
+    '''
+    url = '{0}/dataset/{1}'.format(site_url.rstrip('/'), dataset['name'])
+    starts = []
 
+    def fetch():
+        starts.append(time.time())
+        return session.get(url)
 
-def verify_dataset_via_web_ui(dataset):
-    response = requests.get('http://127.0.0.1:5000/dataset/{0}'.format(
-        dataset['name']))
+    response = with_retries(fetch)
+    latency = time.time() - starts[-1]
     assert response.status_code == 200
+    return (latency, len(starts) - 1)
+
+
+def percentile(sorted_values, percent):
+    '''Return the nearest-rank percentile of a sorted list of values.'''
+    index = int(math.ceil(percent / 100.0 * len(sorted_values))) - 1
+    return sorted_values[max(index, 0)]
+
+
+def print_latency_report(timings, slowest=10):
+    '''Print percentiles and the slowest pages from (latency, name) pairs.'''
+    if not timings:
+        return
+    latencies = sorted(latency for (latency, name) in timings)
+    print("Page load times for {0} datasets: p50 {1:.0f}ms, p95 {2:.0f}ms, "
+          "p99 {3:.0f}ms, max {4:.0f}ms".format(
+              len(latencies), percentile(latencies, 50) * 1000,
+              percentile(latencies, 95) * 1000,
+              percentile(latencies, 99) * 1000, latencies[-1] * 1000))
+    print("Slowest pages:")
+    for (latency, name) in sorted(timings, reverse=True)[:slowest]:
+        print("  {0:.0f}ms {1}".format(latency * 1000, name))
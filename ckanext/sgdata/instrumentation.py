@@ -0,0 +1,188 @@
+'''Opt-in timing of the plugin's template helpers and actions.
+
+When ``ckanext.sgdata.instrumentation`` is enabled the plugin wraps each of
+its helpers and actions with :py:func:`instrument`, and also provides
+wrapped versions of CKAN's core actions (see :py:func:`core_actions`)
+through IActions, so that actions called by other code with
+``toolkit.get_action()`` are recorded too. Each wrapped call records its
+name, its time (including the time of any calls it makes) and the number of
+actions it called, into a per-thread record of the current request.
+
+:py:class:`InstrumentationMiddleware` starts a new record at the start of
+each request and adds it to the process-wide totals at the end, which are
+what the ``sgdata_perf_stats`` action returns.
+
+When instrumentation is disabled nothing is wrapped, so it costs nothing.
+
+'''
+import importlib
+import logging
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+
+# Set from the ckanext.sgdata.instrumentation config setting by the plugin.
+enabled = False
+
+
+class Recorder(object):
+
+    '''Per-request and process-wide call statistics.
+
+    The statistics for each function are kept as a dict with the number of
+    ``calls``, their total ``time`` in seconds and the number of nested
+    ``action_calls`` they made.
+
+    '''
+
+    def __init__(self):
+        self.requests = 0
+        self.totals = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def _calls(self):
+        calls = getattr(self._local, 'calls', None)
+        if calls is None:
+            calls = self._local.calls = {}
+            self._local.stack = []
+        return calls
+
+    def enter(self, name):
+        '''Record the start of a call, and count it as nested in its caller.'''
+        calls = self._calls()
+        stack = self._local.stack
+        if stack and name.startswith('action:'):
+            calls[stack[-1]]['action_calls'] += 1
+        if name not in calls:
+            calls[name] = {'calls': 0, 'time': 0.0, 'action_calls': 0}
+        stack.append(name)
+
+    def exit(self, name, elapsed):
+        '''Record the end of a call that took elapsed seconds.'''
+        stats = self._calls()[name]
+        stats['calls'] += 1
+        stats['time'] += elapsed
+        self._local.stack.pop()
+
+    def start_request(self):
+        self._local.calls = {}
+        self._local.stack = []
+
+    def end_request(self):
+        '''Add this request's statistics to the totals, and return them.'''
+        calls = self._calls()
+        with self._lock:
+            self.requests += 1
+            for (name, stats) in calls.items():
+                totals = self.totals.setdefault(
+                    name, {'calls': 0, 'time': 0.0, 'action_calls': 0})
+                for key in stats:
+                    totals[key] += stats[key]
+        self.start_request()
+        return calls
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests,
+                    'calls': dict((name, dict(stats)) for (name, stats)
+                                  in self.totals.items())}
+
+
+recorder = Recorder()
+
+
+def instrument(kind, name, func):
+    '''Return a wrapper of func that records its calls as ``kind:name``.'''
+    key = '{0}:{1}'.format(kind, name)
+
+    def wrapper(*args, **kwargs):
+        recorder.enter(key)
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            recorder.exit(key, time.time() - start)
+
+    wrapper.__name__ = getattr(func, '__name__', name)
+    wrapper.__doc__ = func.__doc__
+    wrapper.__dict__.update(getattr(func, '__dict__', {}))
+    wrapper.instrumented = True
+    return wrapper
+
+
+def instrument_all(kind, funcs):
+    '''Return a copy of a dict of named functions, each one instrumented.'''
+    return dict((name, instrument(kind, name, func))
+                for (name, func) in funcs.items())
+
+
+# The modules that CKAN loads its core actions from. patch is only in
+# CKAN 2.3 and later.
+CORE_ACTION_MODULES = ('get', 'create', 'update', 'delete', 'patch')
+
+
+def core_actions(exclude=()):
+    '''Return CKAN's core action functions, by name.
+
+    Like ``ckan.logic.get_action()`` this only includes the public functions
+    that are defined in the action modules, not ones imported into them. The
+    names in exclude, eg. the actions that other plugins override, are left
+    out.
+
+    '''
+    actions = {}
+    for module_name in CORE_ACTION_MODULES:
+        module_path = 'ckan.logic.action.' + module_name
+        try:
+            module = importlib.import_module(module_path)
+        except ImportError:
+            continue
+        for (name, func) in vars(module).items():
+            if (not name.startswith('_') and callable(func)
+                    and getattr(func, '__module__', None) == module_path
+                    and name not in exclude):
+                actions[name] = func
+    return actions
+
+
+def summary(calls, limit=5):
+    '''Return a one-line summary of a request's slowest calls.'''
+    slowest = sorted(calls.items(), key=lambda item: item[1]['time'],
+                     reverse=True)[:limit]
+    return ', '.join(
+        '{0} x{1} {2:.1f}ms ({3} actions)'.format(
+            name, stats['calls'], stats['time'] * 1000,
+            stats['action_calls'])
+        for (name, stats) in slowest)
+
+
+class InstrumentationMiddleware(object):
+
+    '''WSGI middleware that collects the statistics of each request.
+
+    If ``log_requests`` is true a summary of each request's slowest calls is
+    logged.
+
+    '''
+
+    def __init__(self, app, log_requests=False):
+        self.app = app
+        self.log_requests = log_requests
+
+    def __call__(self, environ, start_response):
+        recorder.start_request()
+        start = time.time()
+        try:
+            return self.app(environ, start_response)
+        finally:
+            elapsed = time.time() - start
+            calls = recorder.end_request()
+            if self.log_requests and calls:
+                log.info('{0} {1} {2:.1f}ms: {3}'.format(
+                    environ.get('REQUEST_METHOD'),
+                    environ.get('PATH_INFO'), elapsed * 1000,
+                    summary(calls)))
@@ -0,0 +1,122 @@
+'''The site's keywords (free tags): their normalisation and autocompletion.
+
+:py:func:`normalise_tags` is the one place that turns the keywords typed into
+the dataset form, or read from the import CSV file, into tag names, so both
+produce the same tags.
+
+For autocompletion the keywords are loaded with one ``tag_list`` call into a
+:py:class:`ckanext.sgdata.lookups.TokenIndex` that's shared by every request
+in the process, so suggesting keywords as the user types doesn't query the
+database. Like the vocabulary registry the index is dropped when a tag is
+created or deleted, and after ``ttl`` seconds so that keywords added by
+other processes, or by creating datasets, are picked up.
+
+'''
+import logging
+import re
+import string
+import threading
+import time
+
+import ckan.plugins.toolkit as toolkit
+
+import ckanext.sgdata.lookups as lookups
+
+
+log = logging.getLogger(__name__)
+
+
+# The characters other than letters and digits that tag names can contain.
+TAG_PUNCTUATION = '-._ '
+
+# The characters that aren't allowed in tag names, as CKAN's
+# tag_name_validator allows any unicode letter or digit.
+_DISALLOWED = re.compile(
+    u'[^\\w{0}]'.format(re.escape(TAG_PUNCTUATION)), re.UNICODE)
+
+# For ASCII byte strings: a translation table that lower-cases the letters,
+# and the ASCII bytes that translating deletes (the ones _DISALLOWED
+# matches). Non-ASCII bytes are kept, so that decoding the result as ASCII
+# fails for them and they go through _DISALLOWED instead.
+_ASCII_TABLE = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_ASCII_DELETE = ''.join(
+    chr(i) for i in range(128)
+    if not (chr(i).isalnum() or chr(i) in TAG_PUNCTUATION))
+
+
+def normalise_tag(name):
+    '''Return a keyword as a valid, lower-case tag name.
+
+    Characters that aren't allowed in tag names are removed, along with any
+    leading or trailing whitespace. The result may be empty. Byte strings
+    are treated as UTF-8, so they give the same unicode tag as the same
+    keyword typed into the dataset form.
+
+    '''
+    if not isinstance(name, unicode):
+        # Translating is about twice as fast as the regex, and gives the same
+        # tag for keywords that are all ASCII.
+        try:
+            return name.translate(_ASCII_TABLE, _ASCII_DELETE).strip().decode(
+                'ascii')
+        except UnicodeDecodeError:
+            name = name.decode('utf-8', 'replace')
+    return _DISALLOWED.sub(u'', name).strip().lower()
+
+
+def normalise_tags(names):
+    '''Normalise a list of keywords, dropping empty ones and duplicates.
+
+    The tags are returned in the order they were first given in.
+
+    '''
+    tags = []
+    seen = set()
+    for name in names:
+        tag = normalise_tag(name)
+        if tag and tag not in seen:
+            seen.add(tag)
+            tags.append(tag)
+    return tags
+
+
+class KeywordIndex(object):
+
+    '''A lazily loaded, periodically refreshed index of the free tags.'''
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self.queries = 0
+        self._index = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def _expired(self):
+        return (self._index is None
+                or time.time() - self._loaded_at > self.ttl)
+
+    def get(self):
+        '''Return the :py:class:`~ckanext.sgdata.lookups.TokenIndex`.'''
+        if not self._expired():
+            return self._index
+        with self._lock:
+            if self._expired():
+                self.queries += 1
+                names = toolkit.get_action('tag_list')(
+                    {'ignore_auth': True}, {})
+                self._index = lookups.TokenIndex(
+                    (name, [name.lower()] + lookups.words(name), name.lower())
+                    for name in names)
+                self._loaded_at = time.time()
+                log.debug("Indexed {0} keywords".format(len(names)))
+        return self._index
+
+    def search(self, text, limit=10):
+        return self.get().search(text, limit)
+
+    def invalidate(self):
+        '''Drop the index so it's reloaded on the next search.'''
+        self._index = None
+
+
+index = KeywordIndex()
@@ -0,0 +1,279 @@
+'''Indexes of the site's fixed lookup data, such as the dataset categories.
+
+Each index is built once from its data file and then shared by every request
+in the process. It's only rebuilt if the file's modification time changes.
+
+'''
+import bisect
+import collections
+import hashlib
+import itertools
+import json
+import logging
+import os.path
+import re
+import threading
+
+
+log = logging.getLogger(__name__)
+
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+CATEGORIES_FILE = os.path.join(HERE, '..', '..', 'categories.json')
+
+# The file that categories.py builds categories.json from.
+CATEGORIES_SOURCE_FILE = os.path.join(HERE, '..', '..', 'categories.csv')
+
+# The version of the categories.json format written by categories.py. The
+# plugin refuses to load a file with any other version.
+CATEGORIES_FORMAT_VERSION = 2
+
+DEPARTMENTS_FILE = os.path.join(HERE, '..', '..', 'departments.json')
+
+
+Category = collections.namedtuple('Category', 'value label categories')
+
+SubCategory = collections.namedtuple(
+    'SubCategory', 'value label parent_value parent_label categories')
+
+CategoryCode = collections.namedtuple(
+    'CategoryCode', 'value label level parent_value path')
+
+Categories = collections.namedtuple('Categories',
+                                    'tree by_value by_code search')
+
+Agency = collections.namedtuple('Agency', 'value label departments')
+
+Department = collections.namedtuple(
+    'Department', 'value label agency_value agency_label')
+
+Departments = collections.namedtuple('Departments', 'tree by_value')
+
+
+def _code_key(value):
+    '''Sort key for category codes like "1", "1.02" and "24.01".'''
+    return tuple(int(part) for part in value.split('.'))
+
+
+_WORD = re.compile(r'[\w.]+', re.UNICODE)
+
+
+def words(text):
+    '''Split text into the lower-case words that a TokenIndex matches on.'''
+    return [word for word in
+            (match.strip('.') for match in _WORD.findall(text.lower()))
+            if word]
+
+
+class TokenIndex(object):
+
+    '''A prefix index of the words that describe a set of entries.
+
+    ``entries`` is an iterable of ``(key, words, rank)`` tuples. A search for
+    some text matches the entries that have a word starting with each word of
+    the text. The keys of the first ``limit`` matches are returned, ordered
+    by the matching word and then by rank.
+
+    All the entries' words are kept in one sorted list, so the entries with a
+    word starting with a prefix are a contiguous slice of it, found with a
+    binary search. A search walks the narrowest slice of the search's words
+    and stops as soon as it has found ``limit`` matches, so its cost doesn't
+    depend on how many entries there are.
+
+    '''
+
+    def __init__(self, entries):
+        self._entry_words = {}
+        triples = set()
+        for (key, entry_words, rank) in entries:
+            self._entry_words[key] = tuple(set(entry_words))
+            triples.update((word, rank, key) for word in entry_words)
+        triples = sorted(triples)
+        self._words = [word for (word, rank, key) in triples]
+        self._keys = [key for (word, rank, key) in triples]
+
+    def _slice(self, prefix):
+        '''Return the range of the words that start with prefix.'''
+        start = bisect.bisect_left(self._words, prefix)
+        end = bisect.bisect_left(self._words, prefix + u'\uffff', start)
+        return (start, end)
+
+    def _matches(self, key, prefixes):
+        return all(any(word.startswith(prefix)
+                       for word in self._entry_words[key])
+                   for prefix in prefixes)
+
+    def search(self, text, limit=10):
+        prefixes = words(text)
+        if not prefixes or limit < 1:
+            return []
+        # Walk the entries of the least common word, and check the others.
+        slices = []
+        for prefix in set(prefixes):
+            (start, end) = self._slice(prefix)
+            slices.append((end - start, start, end, prefix))
+        slices.sort()
+        (_, start, end, prefix) = slices[0]
+        others = [other for (_, _, _, other) in slices[1:]]
+
+        keys = []
+        seen = set()
+        for key in itertools.islice(self._keys, start, end):
+            if key in seen:
+                continue
+            seen.add(key)
+            if others and not self._matches(key, others):
+                continue
+            keys.append(key)
+            if len(keys) == limit:
+                break
+        return keys
+
+
+def categories_checksum(codes):
+    '''Return the checksum of the flat category index in categories.json.'''
+    return hashlib.sha256(json.dumps(
+        codes, sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+class FileIndex(object):
+
+    '''An index built from a JSON data file.
+
+    Subclasses implement :py:meth:`build` to turn the file's contents into
+    whatever structure they want to serve. :py:meth:`get` returns the built
+    index, rebuilding it first if the file has been modified since it was
+    last read.
+
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.builds = 0
+        self._mtime = None
+        self._index = None
+        self._lock = threading.Lock()
+
+    def build(self, data):
+        raise NotImplementedError
+
+    def get(self):
+        mtime = os.path.getmtime(self.path)
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    with open(self.path, 'r') as f:
+                        self._index = self.build(json.load(f))
+                    self._mtime = mtime
+                    self.builds += 1
+                    log.debug("Built {0} from {1}".format(
+                        self.__class__.__name__, self.path))
+        return self._index
+
+
+class CategoryIndex(FileIndex):
+
+    '''The dataset categories from categories.json, as built by categories.py.
+
+    The file holds a flat index of every category code, from the first-level
+    codes like "1" down to any third-level codes like "1.02.03". Its format
+    version and checksum are checked when it's loaded, and so is the
+    checksum of the categories.csv file it was built from if that file is
+    present (it needn't be deployed). A :py:class:`ValueError` is raised if
+    any of them doesn't match.
+
+    ``get().by_code`` maps every code to its :py:class:`CategoryCode`, whose
+    ``path`` is the tuple of codes from the first level down to it.
+    ``get().tree`` is a tuple of :py:class:`Category`, each with a tuple of
+    its second-level :py:class:`SubCategory`, each with a tuple of its
+    third-level :py:class:`CategoryCode`, all sorted by category code.
+    ``get().by_value`` maps each second-level category code to its
+    :py:class:`SubCategory`. ``get().search`` is a :py:class:`TokenIndex` of
+    the second and third-level codes and their labels.
+
+    '''
+
+    def __init__(self, path, source_path=None):
+        super(CategoryIndex, self).__init__(path)
+        self.source_path = source_path
+
+    def build(self, data):
+        if data.get('format_version') != CATEGORIES_FORMAT_VERSION:
+            raise ValueError(
+                "{0} has format version {1}, expected {2}: rebuild it with "
+                "categories.py".format(self.path, data.get('format_version'),
+                                       CATEGORIES_FORMAT_VERSION))
+        if categories_checksum(data['categories']) != data['checksum']:
+            raise ValueError("{0} doesn't match its checksum: rebuild it "
+                             "with categories.py".format(self.path))
+        if self.source_path and os.path.exists(self.source_path):
+            with open(self.source_path, 'rb') as f:
+                source_checksum = hashlib.sha256(f.read()).hexdigest()
+            if source_checksum != data['source_checksum']:
+                raise ValueError("{0} has changed since {1} was built from "
+                                 "it: rebuild it with categories.py".format(
+                                     self.source_path, self.path))
+
+        by_code = dict(
+            (code, CategoryCode(value=code, label=c['label'],
+                                level=c['level'], parent_value=c['parent'],
+                                path=tuple(c['path'])))
+            for (code, c) in data['categories'].items())
+
+        children = collections.defaultdict(list)
+        for code in sorted(by_code, key=_code_key):
+            children[by_code[code].parent_value].append(by_code[code])
+
+        tree = []
+        by_value = {}
+        for category in children[None]:
+            subcategories = tuple(
+                SubCategory(value=sc.value, label=sc.label,
+                            parent_value=category.value,
+                            parent_label=category.label,
+                            categories=tuple(children[sc.value]))
+                for sc in children[category.value])
+            for subcategory in subcategories:
+                by_value[subcategory.value] = subcategory
+            tree.append(Category(value=category.value,
+                                 label=category.label,
+                                 categories=subcategories))
+        search = TokenIndex(
+            (c.value, [c.value] + words(c.label), _code_key(c.value))
+            for c in by_code.values() if c.level > 1)
+
+        return Categories(tree=tuple(tree), by_value=by_value,
+                          by_code=by_code, search=search)
+
+
+class DepartmentIndex(FileIndex):
+
+    '''The agencies and their departments from departments.json.
+
+    ``get().tree`` is a tuple of :py:class:`Agency`, each with a tuple of
+    :py:class:`Department`, both sorted by label. ``get().by_value`` maps
+    each department code to its :py:class:`Department`.
+
+    '''
+
+    def build(self, data):
+        tree = []
+        by_value = {}
+        for agency in sorted(data.values(), key=lambda a: a['label']):
+            departments = tuple(
+                Department(value=d['value'], label=d['label'],
+                           agency_value=agency['value'],
+                           agency_label=agency['label'])
+                for d in sorted(agency['departments'].values(),
+                                key=lambda d: d['label']))
+            for department in departments:
+                by_value[department.value] = department
+            tree.append(Agency(value=agency['value'], label=agency['label'],
+                               departments=departments))
+        return Departments(tree=tuple(tree), by_value=by_value)
+
+
+categories = CategoryIndex(CATEGORIES_FILE, CATEGORIES_SOURCE_FILE)
+
+departments = DepartmentIndex(DEPARTMENTS_FILE)
@@ -1,12 +1,23 @@
+import copy
 import datetime
+import hashlib
+import json
 import logging
 import os.path
-import json
+
+import pylons
 
 import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 import ckan.lib.helpers as helpers
 import ckan.model
+import ckan.controllers.package
+
+import ckanext.sgdata.cache as cache
+import ckanext.sgdata.instrumentation as instrumentation
+import ckanext.sgdata.keywords as keywords
+import ckanext.sgdata.lookups as lookups
+import ckanext.sgdata.vocabularies as vocabularies
 
 
 SIMPLE_MANDATORY_TEXT_FIELDS = (
@@ -40,6 +51,27 @@ SIMPLE_OPTIONAL_TEXT_FIELDS = (
     'data_compiler_contact_email_address',
     'department',
     'purpose',
+    # A hash of the dataset as it was last imported by `paster sgdataimport`.
+    'import_hash',
+    )
+
+
+# The date fields of the dataset form and the format they're entered in.
+DATE_FIELDS = ('reference-period-start', 'reference-period-end',
+               'available-from')
+
+DATE_FORMAT = '%m/%d/%Y'
+
+
+# The custom fields of the dataset schema, as (name, kind, required) tuples.
+# Text and date fields are stored as extras, vocabulary fields as a single tag
+# from the vocabulary with the same name as the field.
+DATASET_FIELDS = (
+    tuple((field, 'text', True) for field in SIMPLE_MANDATORY_TEXT_FIELDS) +
+    tuple((field, 'text', False) for field in SIMPLE_OPTIONAL_TEXT_FIELDS) +
+    tuple((field, 'date', False) for field in DATE_FIELDS) +
+    tuple((name, 'vocabulary', True)
+          for (name, tags) in vocabularies.VOCABULARIES)
     )
 
 
@@ -64,23 +96,67 @@ def _change_error_dict(err):
     return errors
 
 
+# The most datasets that can be checked by one sgdata_validate_batch call.
+VALIDATE_BATCH_LIMIT = 1000
+
+
+def _parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
 def _custom_validation(data_dict):
+    '''Check a dataset dict against our rules, without using the database.
+
+    This is run before core CKAN's validation so that bad input is rejected
+    without the cost of a database session. It only uses data that's held in
+    memory: the mandatory fields, the vocabulary registry and the category
+    and department indexes.
 
+    '''
     errors = {}
 
-    if not data_dict.get('tags'):
-        errors['keywords'] = ['Missing value']
+    if not data_dict.get('title'):
+        errors['title'] = ['Missing value']
 
-    if (data_dict.get('reference-period-start')
-            and data_dict.get('reference-period-end')):
+    for field in SIMPLE_MANDATORY_TEXT_FIELDS:
+        if not data_dict.get(field):
+            errors[field] = ['Missing value']
 
-        # TODO: Handle invalid date strings.
-        start = datetime.datetime.strptime(data_dict['reference-period-start'],
-                                           '%m/%d/%Y')
-        end = datetime.datetime.strptime(data_dict['reference-period-end'],
-                                         '%m/%d/%Y')
+    if not data_dict.get('tags'):
+        errors['keywords'] = ['Missing value']
 
-        if start > end:
+    tags = vocabularies.registry.get()
+    for (vocab, initial_tags) in vocabularies.VOCABULARIES:
+        value = data_dict.get(vocab)
+        if isinstance(value, (list, tuple)):
+            value = value[0] if value else None
+        if not value:
+            errors[vocab] = ['Missing value']
+        elif vocab in tags and value not in tags[vocab]:
+            errors[vocab] = ['Value must be one of: {0}'.format(
+                ', '.join(tags[vocab]))]
+
+    category = data_dict.get('category')
+    if category and _category_path(category) is None:
+        errors['category'] = ['Unknown category']
+
+    department = data_dict.get('department')
+    if department and department not in lookups.departments.get().by_value:
+        errors['department'] = ['Unknown department']
+
+    dates = {}
+    for field in DATE_FIELDS:
+        if data_dict.get(field):
+            dates[field] = _parse_date(data_dict[field])
+            if dates[field] is None:
+                errors[field] = ['Invalid date, use the format MM/DD/YYYY']
+
+    if dates.get('reference-period-start') and dates.get(
+            'reference-period-end'):
+        if dates['reference-period-start'] > dates['reference-period-end']:
             errors['reference-period-start'] = [
                 'Start date must be before end date']
             errors['reference-period-end'] = [
@@ -89,20 +165,41 @@ def _custom_validation(data_dict):
     return errors
 
 
+def _normalise_tags(data_dict):
+    '''Normalise a submitted dataset's keywords, in place.
+
+    The keywords can be given as a list of ``tags`` dicts, a comma-separated
+    ``tag_string`` or both (as the dataset form does), so both are normalised
+    the same way as the importer's keywords.
+
+    '''
+    if data_dict.get('tag_string'):
+        data_dict['tag_string'] = u','.join(keywords.normalise_tags(
+            data_dict['tag_string'].split(',')))
+
+    if data_dict.get('tags'):
+        vocab_tags = [tag for tag in data_dict['tags']
+                      if tag.get('vocabulary_id')]
+        free_tags = keywords.normalise_tags(
+            tag.get('name', '') for tag in data_dict['tags']
+            if not tag.get('vocabulary_id'))
+        data_dict['tags'] = [{'name': name} for name in free_tags] + vocab_tags
+
+
 def package_create(context, data_dict):
     import ckan.logic.action.create
 
-    create_vocabs()
-
+    _normalise_tags(data_dict)
     error_dict = _custom_validation(data_dict)
+    if error_dict:
+        raise toolkit.ValidationError(error_dict)
 
     try:
         result = ckan.logic.action.create.package_create(context, data_dict)
     except toolkit.ValidationError as err:
-        error_dict.update(_change_error_dict(err))
+        raise toolkit.ValidationError(_change_error_dict(err))
 
-    if error_dict:
-        raise toolkit.ValidationError(error_dict)
+    _remember_last_updater(context, result)
 
     return result
 
@@ -110,171 +207,598 @@ def package_create(context, data_dict):
 def package_update(context, data_dict):
     import ckan.logic.action.update
 
+    _normalise_tags(data_dict)
     error_dict = _custom_validation(data_dict)
+    if error_dict:
+        raise toolkit.ValidationError(error_dict)
 
     try:
         result = ckan.logic.action.update.package_update(context, data_dict)
     except toolkit.ValidationError as err:
-        error_dict.update(_change_error_dict(err))
+        raise toolkit.ValidationError(_change_error_dict(err))
 
-    if error_dict:
-        raise toolkit.ValidationError(error_dict)
+    _remember_last_updater(context, result)
 
     return result
 
 
+@toolkit.side_effect_free
+def sgdata_validate(context, data_dict):
+    '''Check a dataset dict against the site's rules without saving it.
+
+    Only the checks that don't need the database are done: mandatory fields,
+    vocabulary values, category and department codes and dates.
+
+    :returns: ``{'valid': True or False, 'errors': {field: [messages]}}``
+    :rtype: dictionary
+
+    '''
+    toolkit.check_access('package_create', context, {})
+    errors = _custom_validation(data_dict)
+    return {'valid': not errors, 'errors': errors}
+
+
+def sgdata_validate_batch(context, data_dict):
+    '''Check many dataset dicts at once, like sgdata_validate.
+
+    :param datasets: the dataset dicts to check (up to 1000)
+    :type datasets: list of dictionaries
+
+    :returns: a ``{'valid': ..., 'errors': ...}`` dict for each dataset, in
+        the same order as the datasets (an item that isn't a dict is invalid,
+        with a ``dataset`` error)
+    :rtype: list of dictionaries
+
+    '''
+    toolkit.check_access('package_create', context, {})
+    datasets = data_dict.get('datasets')
+    if not isinstance(datasets, list):
+        raise toolkit.ValidationError({'datasets': ['Must be a list']})
+    if len(datasets) > VALIDATE_BATCH_LIMIT:
+        raise toolkit.ValidationError({'datasets': [
+            'At most {0} datasets can be validated at once'.format(
+                VALIDATE_BATCH_LIMIT)]})
+    results = []
+    for dataset in datasets:
+        if isinstance(dataset, dict):
+            errors = _custom_validation(dataset)
+        else:
+            errors = {'dataset': ['Must be a dictionary']}
+        results.append({'valid': not errors, 'errors': errors})
+    return results
+
+
+# The states that sgdata_package_state_update can move a dataset between.
+PACKAGE_STATES = ('draft', 'active')
+
+
+def sgdata_package_state_update(context, data_dict):
+    '''Change the state of a dataset, eg. to activate a draft dataset.
+
+    Only draft datasets can be made active, and only active ones can be made
+    draft again. Datasets in any other state, like deleted ones, can't be
+    changed with this action.
+
+    Unlike package_update this doesn't re-validate or re-save the rest of the
+    dataset, it only changes its state and metadata_modified time. Like
+    package_update it calls the ``edit()`` and ``after_update()`` methods of
+    the IPackageController plugins, and committing the change updates the
+    dataset in the search index.
+
+    :param id: the id or name of the dataset
+    :type id: string
+    :param state: the new state, ``'draft'`` or ``'active'``
+    :type state: string
+
+    :returns: the dataset's id, name and new state
+    :rtype: dictionary
+
+    '''
+    model = context.get('model', ckan.model)
+
+    state = data_dict.get('state')
+    if state not in PACKAGE_STATES:
+        raise toolkit.ValidationError({'state': [
+            'Must be one of: {0}'.format(', '.join(PACKAGE_STATES))]})
+
+    pkg = model.Package.get(data_dict.get('id'))
+    if pkg is None:
+        raise toolkit.ObjectNotFound('Dataset not found')
+
+    toolkit.check_access('package_update', context, {'id': pkg.id})
+
+    if pkg.state not in PACKAGE_STATES:
+        raise toolkit.ValidationError({'state': [
+            "The state of a {0} dataset can't be changed".format(
+                pkg.state)]})
+
+    if pkg.state != state:
+        rev = model.repo.new_revision()
+        rev.author = context.get('user')
+        rev.message = 'Changed dataset state to {0}'.format(state)
+        pkg.state = state
+        pkg.metadata_modified = datetime.datetime.utcnow()
+
+        pkg_dict = toolkit.get_action('package_show')(
+            {'model': model, 'session': model.Session,
+             'user': context.get('user'), 'ignore_auth': True,
+             'use_cache': False},
+            {'id': pkg.id})
+        for item in plugins.PluginImplementations(
+                plugins.IPackageController):
+            item.edit(pkg)
+            item.after_update(context, pkg_dict)
+
+        model.repo.commit()
+
+        _remember_last_updater(context, {
+            'id': pkg.id,
+            'metadata_modified': pkg.metadata_modified.isoformat()})
+
+    return {'id': pkg.id, 'name': pkg.name, 'state': pkg.state}
+
+
+@toolkit.side_effect_free
+def sgdata_perf_stats(context, data_dict):
+    '''Return the helper and action call statistics of this process.
+
+    The call statistics are only collected when
+    ``ckanext.sgdata.instrumentation`` is enabled. Only sysadmins can call
+    this action.
+
+    :returns: whether instrumentation is ``enabled``, the number of
+        ``requests`` that have been recorded, the number of ``calls``, total
+        ``time`` in seconds and number of nested ``action_calls`` for each
+        instrumented helper (``helper:<name>``) and action
+        (``action:<name>``), and the statistics that are always counted: the
+        hits and misses of the dataset page's ``fragments`` cache, the
+        ``vocabularies`` registry's database ``queries`` and cache ``hits``,
+        and the number of ``keyword_queries`` made to load the keyword
+        autocomplete index
+    :rtype: dictionary
+
+    '''
+    toolkit.check_access('sgdata_perf_stats', context, data_dict)
+    stats = instrumentation.recorder.stats()
+    stats['enabled'] = instrumentation.enabled
+    stats['fragments'] = _fragments.stats()
+    stats['vocabularies'] = vocabularies.registry.stats()
+    stats['keyword_queries'] = keywords.index.queries
+    return stats
+
+
+def sgdata_perf_stats_auth(context, data_dict):
+    # Only sysadmins, who skip the auth functions, can see the statistics.
+    return {'success': False,
+            'msg': toolkit._('Only sysadmins can see the performance stats')}
+
+
+# The most suggestions that the autocomplete actions will return at once.
+AUTOCOMPLETE_LIMIT = 100
+
+
+def _autocomplete_params(data_dict):
+    q = data_dict.get('q') or ''
+    try:
+        limit = int(data_dict.get('limit', 10))
+    except (TypeError, ValueError):
+        raise toolkit.ValidationError({'limit': ['Must be a whole number']})
+    return (q, max(0, min(limit, AUTOCOMPLETE_LIMIT)))
+
+
+@toolkit.side_effect_free
+def sgdata_category_autocomplete(context, data_dict):
+    '''Return the categories that match a search, for autocompletion.
+
+    Each word of the search must match the start of a word of a category's
+    label, or of its code. The matches come from an in-memory index, so no
+    database queries are made.
+
+    :param q: the text to search for
+    :type q: string
+    :param limit: the most categories to return (optional, default: 10,
+        maximum: 100)
+    :type limit: int
+
+    :returns: the matching categories, ordered by the word they matched on
+        and then by code, each with its ``value`` (code) and ``label`` and
+        the ``parent_value`` and ``parent_label`` of its first-level category
+    :rtype: list of dictionaries
+
+    '''
+    toolkit.check_access('site_read', context, data_dict)
+    (q, limit) = _autocomplete_params(data_dict)
+    categories = lookups.categories.get()
+    matches = []
+    for value in categories.search.search(q, limit):
+        (first_level, second_level) = _category_path(value)
+        matches.append({'value': value,
+                        'label': categories.by_code[value].label,
+                        'parent_value': first_level.value,
+                        'parent_label': first_level.label})
+    return matches
+
+
+@toolkit.side_effect_free
+def sgdata_keyword_autocomplete(context, data_dict):
+    '''Return the keywords (free tags) that match a search.
+
+    Each word of the search must match the start of a word of the keyword.
+    The matches come from an in-memory index of the keywords, which is
+    refreshed periodically, so no database queries are made for most calls.
+
+    :param q: the text to search for
+    :type q: string
+    :param limit: the most keywords to return (optional, default: 10,
+        maximum: 100)
+    :type limit: int
+
+    :returns: the matching keywords, ordered by the word they matched on and
+        then alphabetically
+    :rtype: list of strings
+
+    '''
+    toolkit.check_access('site_read', context, data_dict)
+    (q, limit) = _autocomplete_params(data_dict)
+    return keywords.index.search(q, limit)
+
+
+# The contact details shown on the dataset contact page.
+CONTACT_FIELDS = (
+    'data_provider',
+    'data_provider_contact_name',
+    'data_provider_contact_designation',
+    'data_provider_contact_department',
+    'data_provider_contact_telephone_number',
+    'data_provider_contact_email_address',
+    'data_provider_alternate_contact_name',
+    'data_provider_alternate_contact_designation',
+    'data_provider_alternate_contact_department',
+    'data_provider_alternate_contact_telephone_number',
+    'data_provider_alternate_contact_email_address',
+    'data_compiler',
+    'data_compiler_contact_name',
+    'data_compiler_contact_designation',
+    'data_compiler_contact_department',
+    'data_compiler_contact_telephone_number',
+    'data_compiler_contact_email_address',
+    )
+
+# The other custom fields that the contact page's sidebar shows.
+CONTACT_PAGE_FIELDS = CONTACT_FIELDS + (
+    'status',
+    'department',
+    'agency_record_identifier',
+    'type_of_data_collection',
+    'frequency',
+    'security_classification',
+    'data_granularity',
+    'publish_on_data_gov_sg',
+    'unit_of_measure',
+    )
+
+# The contact page dicts of datasets, keyed on the dataset's id and
+# metadata_modified and the revision of its organization.
+_contact_details = cache.LRUCache(maxsize=2000)
+
+
+def _contact_details_dict(model, pkg, organization):
+    '''Return the fields of a dataset that its contact page shows.
+
+    That's the CONTACT_PAGE_FIELDS, the dataset's own columns and license
+    fields, and its organization. Unlike package_show this doesn't dictize or
+    validate the dataset's resources, free tags, groups or other extras.
+
+    '''
+    pkg_dict = {
+        'id': pkg.id,
+        'name': pkg.name,
+        'title': pkg.title,
+        'type': pkg.type,
+        'state': pkg.state,
+        'private': pkg.private,
+        'notes': pkg.notes,
+        'owner_org': pkg.owner_org,
+        'license_id': pkg.license_id,
+        'isopen': pkg.isopen(),
+        'metadata_created': pkg.metadata_created.isoformat(),
+        'metadata_modified': pkg.metadata_modified.isoformat(),
+        }
+
+    # The same license fields as package_show.
+    if pkg.license and pkg.license.url:
+        pkg_dict['license_url'] = pkg.license.url
+        pkg_dict['license_title'] = pkg.license.title.split('::')[-1]
+    elif pkg.license:
+        pkg_dict['license_title'] = pkg.license.title
+    else:
+        pkg_dict['license_title'] = pkg.license_id
+
+    for extra in pkg.extras_list:
+        if extra.state == 'active' and extra.key in CONTACT_PAGE_FIELDS:
+            pkg_dict[extra.key] = extra.value
+
+    vocabulary_tags = model.Session.query(
+        model.Vocabulary.name, model.Tag.name).join(
+        model.Tag, model.Tag.vocabulary_id == model.Vocabulary.id).join(
+        model.PackageTag, model.PackageTag.tag_id == model.Tag.id).filter(
+        model.PackageTag.package_id == pkg.id).filter(
+        model.PackageTag.state == 'active').filter(
+        model.Vocabulary.name.in_(CONTACT_PAGE_FIELDS))
+    for (vocab, tag) in vocabulary_tags:
+        pkg_dict[vocab] = tag
+
+    if organization:
+        pkg_dict['organization'] = {
+            'id': organization.id, 'name': organization.name,
+            'title': organization.title,
+            'description': organization.description,
+            'image_url': organization.image_url,
+            'is_organization': True, 'type': organization.type,
+            'state': organization.state}
+    else:
+        pkg_dict['organization'] = None
+
+    return pkg_dict
+
+
+@toolkit.side_effect_free
+def sgdata_package_contact_show(context, data_dict):
+    '''Return the contact details of a dataset.
+
+    This is a cheap alternative to package_show for the dataset contact page.
+    The result is cached until the dataset or its organization is next
+    modified.
+
+    :param id: the id or name of the dataset
+    :type id: string
+
+    :returns: the dataset's contact fields and the other fields shown on
+        the contact page (see ``CONTACT_PAGE_FIELDS``), along with its
+        organization, license fields and the dataset's own columns
+    :rtype: dictionary
+
+    '''
+    model = context.get('model', ckan.model)
+
+    pkg = model.Package.get(data_dict.get('id'))
+    if pkg is None:
+        raise toolkit.ObjectNotFound('Dataset not found')
+    context['package'] = pkg
+
+    toolkit.check_access('package_show', context, {'id': pkg.id})
+
+    organization = model.Group.get(pkg.owner_org) if pkg.owner_org else None
+    key = (pkg.id, pkg.metadata_modified.isoformat(),
+           organization.revision_id if organization else None)
+    pkg_dict = _contact_details.get(key)
+    if pkg_dict is None:
+        pkg_dict = _contact_details_dict(model, pkg, organization)
+        _contact_details.set(key, pkg_dict)
+    # Callers can change the dict, so don't give them the cached one.
+    return copy.deepcopy(pkg_dict)
+
+
 def today():
     return datetime.datetime.now().strftime('%m/%d/%Y')
 
 
-def _create_vocabulary(name, tags):
-    user = toolkit.get_action('get_site_user')({'ignore_auth': True}, {})
-    context = {'user': user['name']}
-    try:
-        data = {'id': name}
-        toolkit.get_action('vocabulary_show')(context, data)
-        logging.info("{name} vocabulary already exists, skipping.".format(
-            name=name))
-    except toolkit.ObjectNotFound:
-        logging.info("Creating vocabulary '{name}'".format(name=name))
-        data = {'name': name}
-        vocab = toolkit.get_action('vocabulary_create')(context, data)
-
-        for tag in tags:
-            logging.info(
-                "Adding tag {tag} to vocab {vocab}".format(tag=tag,
-                                                           vocab=name))
-            data = {'name': tag, 'vocabulary_id': vocab['id']}
-            toolkit.get_action('tag_create')(context, data)
-
-
-def _get_tags_from_vocabulary(name, initial_tags):
-    _create_vocabulary(name, initial_tags)
-    try:
-        tags = toolkit.get_action('tag_list')(
-            data_dict={'vocabulary_id': name})
-        return tags
-    except toolkit.ObjectNotFound:
-        return []
+def _get_tags_from_vocabulary(name):
+    return vocabularies.registry.tags(name)
 
 
 def types_of_data_collection():
-    return _get_tags_from_vocabulary('type_of_data_collection',
-                                     ('Survey Data Collection',
-                                     'Administrative Data Collection',
-                                     'Mix of Survey and Administrative Data Collection',
-                                     'Others'))
+    return _get_tags_from_vocabulary('type_of_data_collection')
 
 
 def statuses():
-    return _get_tags_from_vocabulary('status',
-                                     ('Active', 'Discontinued', 'Replaced',
-                                     'To be Collected'))
+    return _get_tags_from_vocabulary('status')
 
 
 def frequencies():
-    return _get_tags_from_vocabulary(
-        'frequency', ('Daily', 'Weekly', 'Monthly', 'Quarterly',
-        'Half Yearly', 'Annually', 'Ad-Hoc', 'Others'))
+    return _get_tags_from_vocabulary('frequency')
 
 
 def security_classifications():
-    return _get_tags_from_vocabulary(
-        'security_classification', ('Unclassified', 'Restricted',
-        'Confidential', 'Secret'))
+    return _get_tags_from_vocabulary('security_classification')
 
 
 def data_granularities():
-    return _get_tags_from_vocabulary(
-        'data_granularity', ('Aggregated Data', 'Individual Record'))
+    return _get_tags_from_vocabulary('data_granularity')
 
 
 def publish_on_data_gov_sg():
-    return _get_tags_from_vocabulary(
-        'publish_on_data_gov_sg', ('No', 'Yes - publish both metadata and data',
-        'Yes - publish metadata only'))
+    return _get_tags_from_vocabulary('publish_on_data_gov_sg')
 
 
-def create_vocabs():
-    types_of_data_collection()
-    statuses()
-    frequencies()
-    security_classifications()
-    data_granularities()
-    publish_on_data_gov_sg()
+def _invalidate_vocabularies(action):
+    '''Wrap a core tag or vocabulary action to invalidate the tag caches.'''
+    def wrapper(context, data_dict):
+        result = action(context, data_dict)
+        vocabularies.registry.invalidate()
+        keywords.index.invalidate()
+        return result
+    return wrapper
 
 
 def categories():
+    return lookups.categories.get().tree
+
+
+def _category_path(value):
+    '''Return the first and second level categories of a category code.
+
+    The code can be a second-level code like "1.02" or a third-level code
+    like "1.02.03". Returns None for any other value.
+
+    '''
+    by_code = lookups.categories.get().by_code
+    category = by_code.get(value)
+    if category is None or category.level < 2:
+        return None
+    return (by_code[category.path[0]], by_code[category.path[1]])
+
+
+def category_validator(value, context):
+    '''Check that a dataset's category is a known category code.'''
+    if value and _category_path(value) is None:
+        raise toolkit.Invalid(toolkit._('Unknown category'))
+    return value
 
-    path = os.path.join(os.path.dirname(os.path.realpath(__file__)),
-                        '../../categories.json')
-    categories = json.loads(open(path, 'r').read())
-    # FIXME: Sort the values.
-    return categories.values()
+
+# Validators run on a custom field after its required or optional check.
+FIELD_VALIDATORS = {'category': category_validator}
 
 
 def first_level_category(value):
-    for c in categories():
-        for sc in c['categories'].values():
-            if sc['value'] == value:
-                return sc['parent_label']
-    assert False, "Should never get here, unknown category: '{0}'".format(
+    path = _category_path(value)
+    assert path, "Should never get here, unknown category: '{0}'".format(
         value)
+    return path[0].label
 
 
 def second_level_category(value):
-    for c in categories():
-        for sc in c['categories'].values():
-            if sc['value'] == value:
-                return sc['label']
-    assert False, "Should never get here, unknown category: '{0}'".format(
+    path = _category_path(value)
+    assert path, "Should never get here, unknown category: '{0}'".format(
         value)
+    return path[1].label
+
+
+def category_label(value):
+    '''Return the label that the dataset form shows for a category code.
+
+    The form only renders the selected category, the rest are loaded from the
+    category autocomplete endpoint as the user types, so this matches the
+    labels that the endpoint's results are shown with. Returns an empty
+    string for an unknown code, eg. when redisplaying an invalid form.
+
+    '''
+    path = _category_path(value)
+    if path is None:
+        return ''
+    return u'{0} / {1}'.format(
+        path[0].label, lookups.categories.get().by_code[value].label)
 
 
 def departments():
-    return {
-        'DOS': {
-            'value': 'DOS',
-            'label': 'Ministry of Trade and Industry - Department of Statistics',
-            'departments': {
-                'BSD': { 'value': 'BSD', 'label': 'Business Statistics Division'},
-                'CPI': { 'value': 'CPI', 'label': 'Consumer Price Indices'},
-                'EAD': { 'value': 'EAD', 'label': 'Economic Accounts Division'},
-                'IEPD': { 'value': 'IEPD', 'label': 'Income, Expenditure & Population Statistics Division'},
-                'IOTS': { 'value': 'IOTS', 'label': 'Input-output Tables'},
-                'PPD': { 'value': 'PPD', 'label': 'Policy Planning Division'},
-                'PPI': { 'value': 'PPI', 'label': 'Producer Price Indices'},
-                }
-        },
-        'other': {
-            'value': 'other',
-            'label': 'Other agency',
-            'departments': {
-                'none': { 'value': 'none', 'label': 'No department'},
-                }
-        }
-    }
+    return lookups.departments.get().tree
 
 
 def department(value):
-    for agency in departments().values():
-        for department in agency['departments'].values():
-            if department['value'] == value:
-                return department['label']
-    assert False, "We should never get here: Unknown department requested."
+    department = lookups.departments.get().by_value.get(value)
+    assert department, (
+        "We should never get here: Unknown department requested.")
+    return department.label
+
+
+# The user who last updated each dataset, keyed on the dataset's id and
+# metadata_modified so that any change to the dataset makes its entry stale.
+_last_updaters = cache.LRUCache(maxsize=5000)
+
+# Cached as the last updater of a dataset with no activities.
+_NO_UPDATER = object()
+
+
+def _user_summary(user):
+    '''Return the fields of a user dict or object that templates use.'''
+    if isinstance(user, dict):
+        return {'id': user['id'], 'name': user['name'],
+                'display_name': user['display_name']}
+    return {'id': user.id, 'name': user.name,
+            'display_name': user.display_name}
+
+
+def _remember_last_updater(context, pkg_dict):
+    '''Cache the user who just created or updated a dataset.
+
+    Called after package_create and package_update so that the dataset's
+    page can show who last updated it without querying its activity stream.
+
+    '''
+    if not isinstance(pkg_dict, dict) or 'metadata_modified' not in pkg_dict:
+        return
+    user = context.get('auth_user_obj')
+    if not user and context.get('user'):
+        user = ckan.model.User.get(context['user'])
+    if not user:
+        return
+    _last_updaters.set((pkg_dict['id'], pkg_dict['metadata_modified']),
+                       _user_summary(user))
 
 
 def last_update_by(pkg_dict):
-    activities = toolkit.get_action('package_activity_list')(
-            context={}, data_dict={'id': pkg_dict['id']})
-    if not activities:
+    key = (pkg_dict['id'], pkg_dict.get('metadata_modified'))
+    user_dict = _last_updaters.get(key)
+    if user_dict is None:
+        activities = toolkit.get_action('package_activity_list')(
+                context={}, data_dict={'id': pkg_dict['id'], 'limit': 1})
+        if activities:
+            user_dict = _user_summary(toolkit.get_action('user_show')(
+                    context={}, data_dict={'id': activities[0]['user_id']}))
+        else:
+            user_dict = _NO_UPDATER
+        _last_updaters.set(key, user_dict)
+    if user_dict is _NO_UPDATER:
         return None
-    user_id = activities[0]['user_id']
-    user_dict = toolkit.get_action('user_show')(
-            context={}, data_dict={'id': user_id})
     return user_dict
 
 
+# A hash of CKAN's version, the ckanext.sgdata.app_version setting and this
+# extension's code and templates, so that a deploy that changes how pages are
+# rendered also changes their ETags. Set by SGDatasetForm.update_config().
+_app_version = ''
+
+# The app globals that the dataset pages show, which sysadmins can change on
+# the config admin page without a restart, so they're part of the ETags.
+SITE_GLOBALS = ('site_title', 'site_description', 'site_logo',
+                'site_custom_css', 'main_css')
+
+
+def _compute_app_version(config):
+    digest = hashlib.sha1(getattr(ckan, '__version__', ''))
+    digest.update(config.get('ckanext.sgdata.app_version', ''))
+    root = os.path.dirname(os.path.abspath(__file__))
+    for (directory, dirnames, filenames) in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.endswith(('.pyc', '.pyo')):
+                continue
+            path = os.path.join(directory, filename)
+            digest.update(os.path.relpath(path, root))
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()
+
+
+# Rendered fragments of the dataset page. The backend and its size can be
+# changed in the config, see SGDatasetForm.update_config().
+_fragments = cache.FragmentCache(cache.LRUCache(maxsize=1000))
+
+
+def _permission_tier():
+    '''Return which kind of user is viewing the page.'''
+    user = toolkit.c.userobj
+    if user is None:
+        return 'anonymous'
+    if user.sysadmin:
+        return 'sysadmin'
+    return 'user'
+
+
+def cached_snippet(template_name, pkg):
+    '''Render a snippet about a dataset, or return it from the cache.
+
+    The snippet is rendered with the dataset as ``pkg``. It's cached for the
+    dataset's current version, the page's language and the kind of user
+    viewing it, so it must only depend on those.
+
+    '''
+    parts = (_app_version, template_name, pkg['id'], pkg['metadata_modified'],
+             helpers.lang() or '', _permission_tier())
+    return helpers.literal(_fragments.get_or_render(
+        parts, lambda: helpers.snippet(template_name, pkg=pkg)))
+
+
 def first_item_only(value, context):
     if value:
         return value[0]
@@ -282,21 +806,128 @@ def first_item_only(value, context):
         return None
 
 
+# The vocabularies whose tags are copied into their own search index fields.
+INDEXED_VOCABULARIES = ('status', 'frequency', 'security_classification')
+
+
+def _indexed_value(pkg_dict, key):
+    '''Return the value of a custom field from a dict about to be indexed.
+
+    By the time it reaches before_index() CKAN has moved each extra into an
+    ``extras_<key>`` field and each vocabulary's tags into a
+    ``vocab_<name>`` list, so look there as well as at the top level.
+
+    '''
+    for field in (key, 'extras_' + key, 'vocab_' + key):
+        value = pkg_dict.get(field)
+        if isinstance(value, (list, tuple)):
+            value = value[0] if value else None
+        if value:
+            return value
+    return None
+
+
+def sgdata_index_fields(pkg_dict):
+    '''Return the sgdata_* search index fields for a dataset.
+
+    Each field holds the label that should be shown for it as a facet, and
+    the category and department codes are indexed too so that searches can
+    filter on them exactly.
+
+    '''
+    fields = {}
+
+    category = _indexed_value(pkg_dict, 'category')
+    path = _category_path(category) if category else None
+    if path:
+        fields['sgdata_category_code'] = category
+        fields['sgdata_category'] = path[1].label
+        fields['sgdata_first_level_category_code'] = path[0].value
+        fields['sgdata_first_level_category'] = path[0].label
+
+    department = _indexed_value(pkg_dict, 'department')
+    if department:
+        fields['sgdata_department_code'] = department
+        match = lookups.departments.get().by_value.get(department)
+        fields['sgdata_department'] = match.label if match else department
+
+    for name in INDEXED_VOCABULARIES:
+        value = _indexed_value(pkg_dict, name)
+        if value:
+            fields['sgdata_' + name] = value
+
+    return fields
+
+
+# The compiled create, update and show package schemas.
+_schema_templates = {}
+
+
+def _copy_schema(schema):
+    '''Copy a schema's dicts and lists, but not the validators in them.'''
+    copy = {}
+    for (key, value) in schema.items():
+        if isinstance(value, dict):
+            copy[key] = _copy_schema(value)
+        elif isinstance(value, list):
+            copy[key] = list(value)
+        else:
+            copy[key] = value
+    return copy
+
+
 class SGDatasetForm(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     plugins.implements(plugins.IConfigurer)
+    plugins.implements(plugins.IConfigurable)
     plugins.implements(plugins.IDatasetForm)
     plugins.implements(plugins.IRoutes, inherit=True)
     plugins.implements(plugins.IActions)
+    plugins.implements(plugins.IAuthFunctions)
     plugins.implements(plugins.ITemplateHelpers)
     plugins.implements(plugins.IFacets, inherit=True)
+    plugins.implements(plugins.IPackageController, inherit=True)
+    plugins.implements(plugins.IMiddleware, inherit=True)
 
     # IConfigurer
 
     def update_config(self, config):
+        global _app_version
+        _app_version = _compute_app_version(config)
+
+        vocabularies.registry.ttl = int(config.get(
+            'ckanext.sgdata.vocabulary_cache_ttl', 300))
+        lookups.departments.path = config.get(
+            'ckanext.sgdata.departments_file', lookups.DEPARTMENTS_FILE)
+        lookups.categories.get()
+        lookups.departments.get()
+
+        backend = config.get('ckanext.sgdata.fragment_cache.backend')
+        if backend:
+            _fragments.backend = cache.load_backend(backend, config)
+        else:
+            _fragments.backend = cache.LRUCache(maxsize=int(config.get(
+                'ckanext.sgdata.fragment_cache.size', 1000)))
+
+        instrumentation.enabled = toolkit.asbool(config.get(
+            'ckanext.sgdata.instrumentation', False))
+
         toolkit.add_template_directory(config, 'templates')
         toolkit.add_public_directory(config, 'public')
         toolkit.add_resource('resources', 'theme')
 
+    # IConfigurable
+
+    def configure(self, config):
+        if toolkit.asbool(config.get(
+                'ckanext.sgdata.sync_vocabularies_on_startup', True)):
+            try:
+                vocabularies.sync()
+            except Exception:
+                # The database may not have been initialised yet, eg. when
+                # running `paster db init`.
+                logging.exception("Syncing the sgdata vocabularies failed, "
+                                  "run `paster sgdatavocabs sync` to retry")
+
     # IDatasetForm
 
     def is_fallback(self):
@@ -306,131 +937,80 @@ class SGDatasetForm(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
         return ('dataset',)
 
     def _customize_package_schema(self, schema):
-        schema['title'] = [
-            toolkit.get_validator('not_missing'),
-            toolkit.get_validator('not_empty'),
-            unicode]
-
-        for field in SIMPLE_MANDATORY_TEXT_FIELDS:
-            schema[field] = [
-                toolkit.get_validator('not_missing'),
-                toolkit.get_validator('not_empty'),
-                toolkit.get_converter('convert_to_extras')]
-
-        for field in SIMPLE_OPTIONAL_TEXT_FIELDS:
-            schema[field] = [
-                toolkit.get_validator('ignore_missing'),
-                toolkit.get_converter('convert_to_extras')
-                ]
-
-        schema['reference-period-start'] = [
-            toolkit.get_validator('ignore_missing'),
-            toolkit.get_converter('convert_to_extras')]
-
-        schema['reference-period-end'] = [
-            toolkit.get_validator('ignore_missing'),
-            toolkit.get_converter('convert_to_extras')]
-
-        schema['available-from'] = [
-            toolkit.get_validator('ignore_missing'),
-            toolkit.get_converter('convert_to_extras')]
-
-        schema['type_of_data_collection'] = [
-            toolkit.get_validator('not_missing'),
-            toolkit.get_validator('not_empty'),
-            toolkit.get_converter('convert_to_tags')('type_of_data_collection')]
-
-        schema['status'] = [
-            toolkit.get_validator('not_missing'),
-            toolkit.get_validator('not_empty'),
-            toolkit.get_converter('convert_to_tags')('status')]
-
-        schema['frequency'] = [
-            toolkit.get_validator('not_missing'),
-            toolkit.get_validator('not_empty'),
-            toolkit.get_converter('convert_to_tags')('frequency')]
-
-        schema['security_classification'] = [
-            toolkit.get_validator('not_missing'),
-            toolkit.get_validator('not_empty'),
-            toolkit.get_converter('convert_to_tags')('security_classification')]
-
-        schema['data_granularity'] = [
-            toolkit.get_validator('not_missing'),
-            toolkit.get_validator('not_empty'),
-            toolkit.get_converter('convert_to_tags')('data_granularity')]
-
-        schema['publish_on_data_gov_sg'] = [
-            toolkit.get_validator('not_missing'),
-            toolkit.get_validator('not_empty'),
-            toolkit.get_converter('convert_to_tags')('publish_on_data_gov_sg')]
-
-    def create_package_schema(self):
+        not_missing = toolkit.get_validator('not_missing')
+        not_empty = toolkit.get_validator('not_empty')
+        ignore_missing = toolkit.get_validator('ignore_missing')
+        convert_to_extras = toolkit.get_converter('convert_to_extras')
+        convert_to_tags = toolkit.get_converter('convert_to_tags')
+
+        schema['title'] = [not_missing, not_empty, unicode]
+
+        for (field, kind, required) in DATASET_FIELDS:
+            if required:
+                schema[field] = [not_missing, not_empty]
+            else:
+                schema[field] = [ignore_missing]
+            if field in FIELD_VALIDATORS:
+                schema[field].append(FIELD_VALIDATORS[field])
+            if kind == 'vocabulary':
+                schema[field].append(convert_to_tags(field))
+            else:
+                schema[field].append(convert_to_extras)
+
+    def _build_create_package_schema(self):
         schema = super(SGDatasetForm, self).create_package_schema()
         self._customize_package_schema(schema)
         return schema
 
-    def update_package_schema(self):
+    def _build_update_package_schema(self):
         schema = super(SGDatasetForm, self).update_package_schema()
         self._customize_package_schema(schema)
         return schema
 
-    def show_package_schema(self):
+    def _build_show_package_schema(self):
         schema = super(SGDatasetForm, self).show_package_schema()
 
         schema['tags']['__extras'].append(toolkit.get_converter(
             'free_tags_only'))
 
-        for field in (SIMPLE_MANDATORY_TEXT_FIELDS +
-                      SIMPLE_OPTIONAL_TEXT_FIELDS):
-            schema[field] = [
-                toolkit.get_converter('convert_from_extras'),
-                toolkit.get_validator('ignore_missing')]
-
-        schema['reference-period-start'] = [
-            toolkit.get_converter('convert_from_extras'),
-            toolkit.get_validator('ignore_missing')]
-
-        schema['reference-period-end'] = [
-            toolkit.get_converter('convert_from_extras'),
-            toolkit.get_validator('ignore_missing')]
-
-        schema['available-from'] = [
-            toolkit.get_converter('convert_from_extras'),
-            toolkit.get_validator('ignore_missing')]
-
-        schema['type_of_data_collection'] = [
-            toolkit.get_converter('convert_from_tags')('type_of_data_collection'),
-            toolkit.get_validator('ignore_missing'),
-            first_item_only]
-
-        schema['status'] = [
-            toolkit.get_converter('convert_from_tags')('status'),
-            toolkit.get_validator('ignore_missing'),
-            first_item_only]
-
-        schema['frequency'] = [
-            toolkit.get_converter('convert_from_tags')('frequency'),
-            toolkit.get_validator('ignore_missing'),
-            first_item_only]
-
-        schema['security_classification'] = [
-            toolkit.get_converter('convert_from_tags')('security_classification'),
-            toolkit.get_validator('ignore_missing'),
-            first_item_only]
-
-        schema['data_granularity'] = [
-            toolkit.get_converter('convert_from_tags')('data_granularity'),
-            toolkit.get_validator('ignore_missing'),
-            first_item_only]
-
-        schema['publish_on_data_gov_sg'] = [
-            toolkit.get_converter('convert_from_tags')('publish_on_data_gov_sg'),
-            toolkit.get_validator('ignore_missing'),
-            first_item_only]
+        convert_from_extras = toolkit.get_converter('convert_from_extras')
+        convert_from_tags = toolkit.get_converter('convert_from_tags')
+        ignore_missing = toolkit.get_validator('ignore_missing')
+
+        for (field, kind, required) in DATASET_FIELDS:
+            if kind == 'vocabulary':
+                schema[field] = [convert_from_tags(field), ignore_missing,
+                                 first_item_only]
+            else:
+                schema[field] = [convert_from_extras, ignore_missing]
 
         return schema
 
+    def _cached_schema(self, name, build):
+        '''Return a copy of the named schema, building it the first time.
+
+        CKAN asks for the schemas on every package action, so each one is only
+        built once per process and callers get a cheap copy of it that they're
+        free to modify.
+
+        '''
+        schema = _schema_templates.get(name)
+        if schema is None:
+            schema = _schema_templates[name] = build()
+        return _copy_schema(schema)
+
+    def create_package_schema(self):
+        return self._cached_schema('create',
+                                   self._build_create_package_schema)
+
+    def update_package_schema(self):
+        return self._cached_schema('update',
+                                   self._build_update_package_schema)
+
+    def show_package_schema(self):
+        return self._cached_schema('show',
+                                   self._build_show_package_schema)
+
     # IRoutes
 
     def before_map(self, map_):
@@ -443,42 +1023,117 @@ class SGDatasetForm(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
             controller='ckanext.sgdata.plugin:SGDataPackageController',
             action='new_metadata')
 
+        # Keyword and category suggestions from the in-memory indexes, in the
+        # format that CKAN's autocomplete JavaScript module expects.
+        map_.connect(
+            '/api/sgdata/util/{kind}/autocomplete',
+            controller='ckanext.sgdata.plugin:SGDataAutocompleteController',
+            action='autocomplete',
+            requirements={'kind': 'keyword|category'})
+
         map_.connect(
             'dataset_contact',
             '/dataset/contact/{id}',
             controller='ckanext.sgdata.plugin:SGDataPackageController',
             action='contact')
 
+        # Override the dataset read page so that we can answer conditional
+        # requests for it with 304 Not Modified. The requirement keeps the
+        # package controller's other /dataset/<action> pages and the
+        # /dataset/<id>.<format> pages going to the package controller.
+        map_.connect(
+            '/dataset/{id}',
+            controller='ckanext.sgdata.plugin:SGDataPackageController',
+            action='read',
+            requirements={'id': '(?!(new|list|search|autocomplete)$)[^/.]+'})
+
         return map_
 
     # IActions
 
     def get_actions(self):
-        return {'package_create': package_create,
-                'package_update': package_update,
-                }
+        import ckan.logic.action.create
+        import ckan.logic.action.update
+        import ckan.logic.action.delete
+
+        actions = {'package_create': package_create,
+                   'package_update': package_update,
+                   'sgdata_validate': sgdata_validate,
+                   'sgdata_validate_batch': sgdata_validate_batch,
+                   'sgdata_package_state_update': sgdata_package_state_update,
+                   'sgdata_package_contact_show': sgdata_package_contact_show,
+                   'sgdata_perf_stats': sgdata_perf_stats,
+                   'sgdata_category_autocomplete':
+                       sgdata_category_autocomplete,
+                   'sgdata_keyword_autocomplete': sgdata_keyword_autocomplete,
+                   'tag_create': _invalidate_vocabularies(
+                       ckan.logic.action.create.tag_create),
+                   'tag_delete': _invalidate_vocabularies(
+                       ckan.logic.action.delete.tag_delete),
+                   'vocabulary_create': _invalidate_vocabularies(
+                       ckan.logic.action.create.vocabulary_create),
+                   'vocabulary_update': _invalidate_vocabularies(
+                       ckan.logic.action.update.vocabulary_update),
+                   'vocabulary_delete': _invalidate_vocabularies(
+                       ckan.logic.action.delete.vocabulary_delete),
+                   }
+        if instrumentation.enabled:
+            # Provide instrumented versions of the core actions too, except
+            # the ones that other plugins override, as CKAN doesn't allow
+            # two plugins to provide the same action.
+            core_actions = instrumentation.core_actions(
+                exclude=self._other_plugins_actions())
+            core_actions.update(actions)
+            actions = instrumentation.instrument_all('action', core_actions)
+        return actions
+
+    def _other_plugins_actions(self):
+        names = set()
+        for plugin in plugins.PluginImplementations(plugins.IActions):
+            if plugin is not self:
+                names.update(plugin.get_actions())
+        return names
+
+    # IAuthFunctions
+
+    def get_auth_functions(self):
+        return {'sgdata_perf_stats': sgdata_perf_stats_auth}
 
     # ITemplateHelpers
 
     def get_helpers(self):
-        return {'today': today,
-                'types_of_data_collection': types_of_data_collection,
-                'statuses': statuses,
-                'frequencies': frequencies,
-                'security_classifications': security_classifications,
-                'data_granularities': data_granularities,
-                'publish_on_data_gov_sg': publish_on_data_gov_sg,
-                'last_update_by': last_update_by,
-                'categories': categories,
-                'first_level_category': first_level_category,
-                'second_level_category': second_level_category,
-                'departments': departments,
-                'department': department,
-                }
+        template_helpers = {
+            'today': today,
+            'types_of_data_collection': types_of_data_collection,
+            'statuses': statuses,
+            'frequencies': frequencies,
+            'security_classifications': security_classifications,
+            'data_granularities': data_granularities,
+            'publish_on_data_gov_sg': publish_on_data_gov_sg,
+            'last_update_by': last_update_by,
+            'categories': categories,
+            'first_level_category': first_level_category,
+            'second_level_category': second_level_category,
+            'category_label': category_label,
+            'departments': departments,
+            'department': department,
+            'cached_snippet': cached_snippet,
+            }
+        if instrumentation.enabled:
+            template_helpers = instrumentation.instrument_all(
+                'helper', template_helpers)
+        return template_helpers
 
     # IFacets
 
     def _modify_facets_dict(self, facets_dict):
+        facets_dict['sgdata_first_level_category'] = toolkit._('Category')
+        facets_dict['sgdata_category'] = toolkit._('Sub-category')
+        facets_dict['sgdata_department'] = toolkit._('Department')
+        facets_dict['sgdata_status'] = toolkit._('Status')
+        facets_dict['sgdata_frequency'] = toolkit._('Frequency')
+        facets_dict['sgdata_security_classification'] = toolkit._(
+            'Security Classification')
         facets_dict['tags'] = toolkit._('Keywords')
         del facets_dict['res_format']
         del facets_dict['license_id']
@@ -493,20 +1148,98 @@ class SGDatasetForm(plugins.SingletonPlugin, toolkit.DefaultDatasetForm):
     def organization_facets(self, facets_dict, organization_type, package_type):
         return self._modify_facets_dict(facets_dict)
 
-
-class SGDataPackageController(toolkit.BaseController):
+    # IMiddleware
+
+    def make_middleware(self, app, config):
+        if not instrumentation.enabled:
+            return app
+        return instrumentation.InstrumentationMiddleware(
+            app, log_requests=toolkit.asbool(config.get(
+                'ckanext.sgdata.instrumentation.log_requests', False)))
+
+    # IPackageController
+
+    def before_index(self, pkg_dict):
+        pkg_dict.update(sgdata_index_fields(pkg_dict))
+        return pkg_dict
+
+
+class SGDataPackageController(ckan.controllers.package.PackageController):
+
+    def _not_modified(self, pkg):
+        '''Handle conditional GET requests for a dataset's pages.
+
+        Sets an ETag header on the response and returns True if the client's
+        copy of the page is still fresh (in which case the response status is
+        set to 304 and the page shouldn't be rendered).
+
+        Only anonymous viewers get an ETag. A logged-in user's page also
+        depends on their new activities, their role in the organization and
+        whether they follow the dataset, which can't be checked cheaply.
+
+        For anonymous viewers the ETag covers everything that the page
+        depends on: the version of the site's code and templates, the site
+        title, description and logo (which sysadmins can change at runtime),
+        the dataset's and its organization's last changes, its follower count
+        and the language. There's no Last-Modified header, as a date can't
+        cover all of that.
+
+        Only public, active datasets get an ETag, as anyone can see those, so
+        no access check is needed here: package_show does that as usual when
+        the page is rendered.
+
+        '''
+        if toolkit.c.userobj is not None:
+            return False
+
+        if pkg.private or pkg.state != 'active':
+            return False
+
+        # Don't let a cached page hide a flash message that's waiting to be
+        # shown, eg. after the dataset has been edited.
+        if pylons.session.get('flash'):
+            return False
+
+        model = ckan.model
+        organization = (model.Group.get(pkg.owner_org) if pkg.owner_org
+                        else None)
+        site = [getattr(pylons.app_globals, name, None) or ''
+                for name in SITE_GLOBALS]
+        validators = site + [
+            _app_version, pkg.id, pkg.metadata_modified.isoformat(),
+            organization.revision_id if organization else '',
+            unicode(model.UserFollowingDataset.follower_count(pkg.id)),
+            helpers.lang() or '']
+        etag = hashlib.sha1(u'|'.join(validators).encode('utf-8')).hexdigest()
+
+        toolkit.response.etag = etag
+        not_modified = etag in toolkit.request.if_none_match
+        if not_modified:
+            toolkit.response.status_int = 304
+        return not_modified
+
+    def read(self, id, format='html'):
+        pkg = ckan.model.Package.get(id)
+        if pkg is None:
+            return super(SGDataPackageController, self).read(id, format)
+        if self._not_modified(pkg):
+            return ''
+        # This page is routed here rather than to the package controller, so
+        # set c.controller back for the "Dataset" tab to show as active.
+        toolkit.c.controller = 'package'
+        # Now that the package is in the session, package_show and the rest
+        # of read() get it from there by its id without querying it again.
+        return super(SGDataPackageController, self).read(pkg.id, format)
 
     def new_metadata(self, id, data=None, errors=None, error_summary=None):
         import ckan.lib.base as base
 
-        # Change the package state from draft to active and save it.
+        # Change the package state from draft to active.
         context = {'model': ckan.model, 'session': ckan.model.Session,
                    'user': toolkit.c.user or toolkit.c.author,
                    'auth_user_obj': toolkit.c.userobj}
-        data_dict = toolkit.get_action('package_show')(context, {'id': id})
-        data_dict['id'] = id
-        data_dict['state'] = 'active'
-        toolkit.get_action('package_update')(context, data_dict)
+        toolkit.get_action('sgdata_package_state_update')(
+            context, {'id': id, 'state': 'active'})
 
         base.redirect(helpers.url_for(controller='package', action='read',
                                       id=id))
@@ -516,16 +1249,49 @@ class SGDataPackageController(toolkit.BaseController):
         context = {'model': ckan.model, 'session': ckan.model.Session,
                    'user': toolkit.c.user or toolkit.c.author,
                    'for_view': True, 'auth_user_obj': toolkit.c.userobj}
-        data_dict = {'id': id}
+        pkg = ckan.model.Package.get(id)
+        if pkg is not None and self._not_modified(pkg):
+            return ''
+        data_dict = {'id': pkg.id if pkg else id}
 
         try:
-            toolkit.c.pkg_dict = toolkit.get_action('package_show')(context,
-                                                                    data_dict)
+            toolkit.c.pkg_dict = toolkit.get_action(
+                'sgdata_package_contact_show')(context, data_dict)
             toolkit.c.pkg = context['package']
         except toolkit.ObjectNotFound:
-            toolkit.abort(404, _('Dataset not found'))
+            toolkit.abort(404, toolkit._('Dataset not found'))
         except toolkit.NotAuthorized:
             toolkit.abort(401,
                           ('Unauthorized to read dataset %s') % id)
 
         return toolkit.render('package/contact.html')
+
+
+class SGDataAutocompleteController(toolkit.BaseController):
+
+    def autocomplete(self, kind):
+        '''Return keyword or category suggestions for the dataset form.
+
+        The ``incomplete`` parameter is the text typed so far. The result is
+        in the same format as CKAN's /api/2/util/tag/autocomplete, so it can
+        be used as the source of CKAN's autocomplete JavaScript module.
+
+        '''
+        context = {'model': ckan.model, 'session': ckan.model.Session,
+                   'user': toolkit.c.user or toolkit.c.author,
+                   'auth_user_obj': toolkit.c.userobj}
+        data_dict = {'q': toolkit.request.params.get('incomplete', ''),
+                     'limit': toolkit.request.params.get('limit', 10)}
+
+        if kind == 'keyword':
+            results = [{'Name': name} for name in toolkit.get_action(
+                'sgdata_keyword_autocomplete')(context, data_dict)]
+        else:
+            results = [{'Name': category['label'],
+                        'Value': category['value'],
+                        'Parent': category['parent_label']}
+                       for category in toolkit.get_action(
+                           'sgdata_category_autocomplete')(context, data_dict)]
+
+        toolkit.response.content_type = 'application/json;charset=utf-8'
+        return json.dumps({'ResultSet': {'Result': results}})
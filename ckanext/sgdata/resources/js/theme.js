@@ -17,4 +17,42 @@
     };
   });
 
+  // The dataset form's category field. Only the selected category is in the
+  // page, the others are searched for with the category autocomplete API.
+  ckan.module('category-autocomplete', function ($, _) {
+    return {
+      options: {
+        source: null,
+        label: '',
+        placeholder: ''
+      },
+
+      initialize: function () {
+        var label = String(this.options.label || '');
+        this.el.select2({
+          width: 'resolve',
+          minimumInputLength: 1,
+          placeholder: this.options.placeholder,
+          ajax: {
+            url: this.sandbox.client.url(this.options.source),
+            dataType: 'json',
+            quietMillis: 250,
+            data: function (term) {
+              return {incomplete: term, limit: 20};
+            },
+            results: function (data) {
+              return {results: $.map(data.ResultSet.Result, function (item) {
+                return {id: item.Value, text: item.Parent + ' / ' + item.Name};
+              })};
+            }
+          },
+          initSelection: function (element, callback) {
+            var value = element.val();
+            callback({id: value, text: label || value});
+          }
+        });
+      }
+    };
+  });
+
 }(window.jQuery, this.ckan);
@@ -0,0 +1,214 @@
+'''The controlled vocabularies used by the dataset form.
+
+Every dataset form render needs the tags of all six vocabularies, so rather
+than asking CKAN for them each time they're loaded once per process into a
+:py:class:`VocabularyRegistry` and served from memory from then on.
+
+'''
+import logging
+import threading
+import time
+
+import ckan.plugins.toolkit as toolkit
+
+
+log = logging.getLogger(__name__)
+
+
+# The name of each vocabulary and the tags it's initially created with, in the
+# order they should be shown in the dataset form. Each tag is paired with the
+# code that stands for it in the import CSV file.
+VOCABULARY_CODES = (
+    ('type_of_data_collection', (
+        ('SD', 'Survey Data Collection'),
+        ('AD', 'Administrative Data Collection'),
+        ('MX', 'Mix of Survey and Administrative Data Collection'),
+        ('O', 'Others'))),
+    ('status', (
+        ('A', 'Active'),
+        ('D', 'Discontinued'),
+        ('R', 'Replaced'),
+        ('TBC', 'To be Collected'))),
+    ('frequency', (
+        ('D', 'Daily'),
+        ('W', 'Weekly'),
+        ('M', 'Monthly'),
+        ('Q', 'Quarterly'),
+        ('H', 'Half Yearly'),
+        ('A', 'Annually'),
+        ('C', 'Ad-Hoc'),
+        ('O', 'Others'))),
+    ('security_classification', (
+        ('U', 'Unclassified'),
+        ('R', 'Restricted'),
+        ('C', 'Confidential'),
+        ('S', 'Secret'))),
+    ('data_granularity', (
+        ('AD', 'Aggregated Data'),
+        ('IR', 'Individual Record'))),
+    ('publish_on_data_gov_sg', (
+        ('0', 'No'),
+        ('1', 'Yes - publish both metadata and data'),
+        ('2', 'Yes - publish metadata only'))),
+    )
+
+# The name of each vocabulary and its initial tags, in order.
+VOCABULARIES = tuple((name, tuple(tag for (code, tag) in tags))
+                     for (name, tags) in VOCABULARY_CODES)
+
+
+class VocabularyRegistry(object):
+
+    '''An in-memory cache of the tags in each of the site's vocabularies.
+
+    All vocabularies are loaded with a single ``vocabulary_list`` call the
+    first time any of them is asked for. The cache is dropped whenever
+    :py:meth:`invalidate` is called (the plugin does this whenever a tag or
+    vocabulary is changed) and, because other worker processes won't see
+    that, after ``ttl`` seconds as well.
+
+    ``queries`` counts the number of times the vocabularies have been loaded
+    from the database, so a warm cache can be confirmed by checking that it
+    doesn't go up when a page is rendered.
+
+    '''
+
+    def __init__(self, vocabularies, ttl=300):
+        self.vocabularies = vocabularies
+        self.ttl = ttl
+        self.queries = 0
+        self.hits = 0
+        self._tags = None
+        self._loaded_at = 0
+        self._lock = threading.Lock()
+
+    def _expired(self):
+        return (self._tags is None
+                or time.time() - self._loaded_at > self.ttl)
+
+    def _load(self):
+        with self._lock:
+            # Another thread may have reloaded the cache while we were
+            # waiting for the lock.
+            if not self._expired():
+                return self._tags
+
+            self.queries += 1
+            vocabs = toolkit.get_action('vocabulary_list')(
+                {'ignore_auth': True}, {})
+            loaded = dict((vocab['name'],
+                           [tag['name'] for tag in vocab.get('tags', [])])
+                          for vocab in vocabs)
+
+            tags = {}
+            for name, initial_tags in self.vocabularies:
+                if name not in loaded:
+                    continue
+                # Show the tags in the order they were defined in, followed
+                # by any that have been added to the vocabulary since.
+                names = set(loaded[name])
+                ordered = [tag for tag in initial_tags if tag in names]
+                ordered.extend(sorted(names.difference(ordered)))
+                tags[name] = tuple(ordered)
+
+            log.debug("Loaded {0} vocabularies into the vocabulary "
+                      "registry".format(len(tags)))
+            self._tags = tags
+            self._loaded_at = time.time()
+            return tags
+
+    def get(self):
+        '''Return a dict mapping each existing vocabulary to its tags.'''
+        if self._expired():
+            return self._load()
+        self.hits += 1
+        return self._tags
+
+    def exists(self, name):
+        '''Return True if the named vocabulary exists in the database.'''
+        return name in self.get()
+
+    def tags(self, name):
+        '''Return a list of the tag names in the named vocabulary.
+
+        Returns an empty list if the vocabulary doesn't exist.
+
+        '''
+        return list(self.get().get(name, ()))
+
+    def invalidate(self):
+        '''Drop the cached tags so they're reloaded on the next request.'''
+        self._tags = None
+
+    def stats(self):
+        '''Return the registry's query and hit counts, for sgdata_perf_stats.
+
+        Once the registry is warm, ``queries`` stays the same however many
+        pages that use the vocabularies are rendered.
+
+        '''
+        return {'queries': self.queries, 'hits': self.hits,
+                'loaded': self._tags is not None}
+
+
+registry = VocabularyRegistry(VOCABULARIES)
+
+
+def sync():
+    '''Create any of the vocabularies or their tags that don't exist yet.
+
+    The existing vocabularies are fetched with one ``vocabulary_list`` call
+    and compared with :py:data:`VOCABULARIES`, then everything that's missing
+    is added and committed in a single transaction. If anything fails,
+    including looking up the site user, the session is rolled back before
+    the exception is re-raised, so the caller is left with a usable session.
+
+    Returns a list of ``(vocabulary name, tag name)`` tuples for the tags
+    that were added.
+
+    '''
+    import ckan.model as model
+
+    added = []
+    try:
+        # get_site_user may create the site user and vocabulary_list may
+        # fail on an uninitialised database, so both run inside the
+        # transaction that's rolled back on error.
+        site_user = toolkit.get_action('get_site_user')(
+            {'ignore_auth': True}, {})
+        context = {'model': model, 'session': model.Session,
+                   'user': site_user['name'], 'defer_commit': True}
+
+        existing = dict(
+            (vocab['name'], vocab) for vocab in
+            toolkit.get_action('vocabulary_list')(dict(context), {}))
+
+        for name, tags in VOCABULARIES:
+            if name not in existing:
+                log.info("Creating vocabulary '{name}'".format(name=name))
+                toolkit.get_action('vocabulary_create')(
+                    dict(context),
+                    {'name': name, 'tags': [{'name': tag} for tag in tags]})
+                added.extend((name, tag) for tag in tags)
+                continue
+
+            vocab = existing[name]
+            existing_tags = set(tag['name'] for tag in vocab.get('tags', []))
+            for tag in tags:
+                if tag in existing_tags:
+                    continue
+                log.info("Adding tag {tag} to vocab {vocab}".format(
+                    tag=tag, vocab=name))
+                toolkit.get_action('tag_create')(
+                    dict(context), {'name': tag, 'vocabulary_id': vocab['id']})
+                added.append((name, tag))
+
+        if added:
+            model.repo.commit()
+    except Exception:
+        model.Session.rollback()
+        raise
+    finally:
+        registry.invalidate()
+
+    return added
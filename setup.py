@@ -26,5 +26,11 @@ setup(
         [ckan.plugins]
         # Add plugins here, e.g.
         sgdatasetform=ckanext.sgdata.plugin:SGDatasetForm
+
+        [paste.paster_command]
+        sgdataimport=ckanext.sgdata.commands:SGDataImportCommand
+        sgdatavocabs=ckanext.sgdata.commands:SGDataVocabularyCommand
+        sgdataexport=ckanext.sgdata.commands:SGDataExportCommand
+        sgdatasearch=ckanext.sgdata.commands:SGDataSearchCommand
     ''',
 )